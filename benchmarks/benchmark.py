@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  benchmark.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+'''
+Benchmarks the consume and acknowledgement paths of ``AMQPIn`` against the
+in-process ``broker.Broker``.
+
+Each scenario preloads a queue with messages, consumes them all through
+``AMQPIn``, acknowledges each event as soon as it arrives in the outbox and
+reports:
+
+    - msg/s: messages consumed per second
+    - p50/p99: delivery-to-outbox latency in milliseconds
+    - ack/s: acknowledgements received by the broker per second
+    - B/msg: memory allocated per in-flight message while the outbox is
+      not consumed
+
+Usage:
+
+    python benchmarks/benchmark.py --messages 20000 --prefetch 10 100 1000
+'''
+
+from gevent import monkey; monkey.patch_all()
+
+from broker import Broker
+from gevent import sleep, spawn
+from time import time
+from wishbone.actor import ActorConfig
+from wishbone_input_amqp import AMQPIn
+import argparse
+import itertools
+import tracemalloc
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+def createModule(broker, prefetch, consumers, ack_batch_size, size):
+
+    actor_config = ActorConfig('amqp', size, 60, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(
+        actor_config,
+        host=broker.address,
+        queue="benchmark",
+        prefetch_count=prefetch,
+        consumers=consumers,
+        ack_batch_size=ack_batch_size,
+        outbox_high_watermark=0
+    )
+    amqp.pool.queue.outbox.disableFallThrough()
+    return amqp
+
+
+def waitFor(condition, timeout):
+
+    deadline = time() + timeout
+    while not condition() and time() < deadline:
+        sleep(0.01)
+    return condition()
+
+
+def percentile(samples, value):
+
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(len(samples) * value))]
+
+
+def generateMessages(count, body_size):
+
+    padding = b"x" * max(0, body_size - 10)
+    return [(b"%010d%s" % (seq, padding), None) for seq in range(count)]
+
+
+def measureThroughput(prefetch, body_size, consumers, messages, ack_batch_size, timeout):
+
+    broker = Broker()
+    broker.start()
+    delivered_at = {}
+
+    def onDeliver(message):
+        delivered_at[int(message.body[:10])] = time()
+
+    broker.on_deliver = onDeliver
+    broker.enqueue("benchmark", generateMessages(messages, body_size))
+
+    amqp = createModule(broker, prefetch, consumers, ack_batch_size, 1000)
+    latencies = []
+
+    def acknowledge():
+        outbox = amqp.pool.queue.outbox
+        ack = amqp.pool.queue.ack
+        while True:
+            event = outbox.get()
+            latencies.append(time() - delivered_at[int(event.get("data")[:10])])
+            ack.put(event)
+
+    start = time()
+    amqp.start()
+    reader = spawn(acknowledge)
+    consumed = waitFor(lambda: len(latencies) >= messages, timeout)
+    consumed_at = time()
+    acknowledged = waitFor(lambda: broker.acknowledged >= messages, timeout)
+    acknowledged_at = time()
+    reader.kill()
+    amqp.stop()
+    broker.stop()
+
+    latencies.sort()
+    return {
+        "msg/s": len(latencies) / (consumed_at - start),
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "ack/s": broker.acknowledged / (acknowledged_at - start),
+        "complete": consumed and acknowledged
+    }
+
+
+def measureMemory(prefetch, body_size, consumers, ack_batch_size, timeout):
+
+    broker = Broker()
+    broker.start()
+    in_flight = prefetch * consumers
+    amqp = createModule(broker, prefetch, consumers, ack_batch_size, in_flight + 1)
+    amqp.start()
+    waitFor(lambda: all(link.connected for link in amqp.links), timeout)
+    sleep(0.1)
+
+    excluded = [
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "*/broker.py")
+    ]
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot().filter_traces(excluded)
+    broker.enqueue("benchmark", generateMessages(in_flight, body_size))
+    waitFor(lambda: amqp.pool.queue.outbox.size() >= in_flight, timeout)
+    sleep(0.1)
+    snapshot = tracemalloc.take_snapshot().filter_traces(excluded)
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in snapshot.compare_to(baseline, "filename"))
+    amqp.stop()
+    broker.stop()
+    return allocated / float(in_flight)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks AMQPIn against an in-process broker.")
+    parser.add_argument("--messages", type=int, default=10000, help="The number of messages per scenario.")
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[1, 10, 100, 1000], help="The prefetch counts.")
+    parser.add_argument("--body-size", type=int, nargs="+", default=[64, 4096], help="The message body sizes in bytes.")
+    parser.add_argument("--consumers", type=int, nargs="+", default=[1, 4], help="The consumer counts.")
+    parser.add_argument("--ack-batch-size", type=int, default=1, help="The ack_batch_size of AMQPIn.")
+    parser.add_argument("--timeout", type=int, default=120, help="The max number of seconds per scenario.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the memory measurement.")
+    args = parser.parse_args()
+
+    header = "%8s %8s %9s %10s %8s %8s %10s %10s" % ("prefetch", "body", "consumers", "msg/s", "p50(ms)", "p99(ms)", "ack/s", "B/msg")
+    print(header)
+    print("-" * len(header))
+    for prefetch, body_size, consumers in itertools.product(args.prefetch, args.body_size, args.consumers):
+        result = measureThroughput(prefetch, body_size, consumers, args.messages, args.ack_batch_size, args.timeout)
+        if args.no_memory:
+            memory = "-"
+        else:
+            memory = "%.0f" % (measureMemory(prefetch, body_size, consumers, args.ack_batch_size, args.timeout))
+        print("%8s %8s %9s %10.0f %8.2f %8.2f %10.0f %10s%s" % (
+            prefetch,
+            body_size,
+            consumers,
+            result["msg/s"],
+            result["p50"],
+            result["p99"],
+            result["ack/s"],
+            memory,
+            "" if result["complete"] else "  (timeout)"
+        ))
+
+
+if __name__ == '__main__':
+    main()
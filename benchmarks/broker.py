@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  broker.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from gevent import monkey; monkey.patch_all()
+
+from amqp import spec
+from amqp.basic_message import Message
+from amqp.serialization import dumps, loads
+from collections import OrderedDict, deque
+from gevent import sleep, spawn, spawn_later
+from gevent.lock import Semaphore
+from gevent.server import StreamServer
+from struct import pack, unpack_from
+import socket
+
+FRAME_END = b'\xce'
+FRAME_MAX = 131072
+
+CLIENT_METHODS = {
+    spec.Connection.StartOk: 'FsSs',
+    spec.Connection.TuneOk: 'BlB',
+    spec.Connection.Open: 'ssb',
+    spec.Connection.Close: 'BsBB',
+    spec.Connection.CloseOk: '',
+    spec.Channel.Open: 's',
+    spec.Channel.Flow: 'b',
+    spec.Channel.Close: 'BsBB',
+    spec.Channel.CloseOk: '',
+    spec.Exchange.Declare: 'BssbbbbbF',
+    spec.Queue.Declare: 'BsbbbbbF',
+    spec.Queue.Bind: 'BsssbF',
+    spec.Basic.Qos: 'lBb',
+    spec.Basic.Consume: 'BssbbbbF',
+    spec.Basic.Cancel: 'sb',
+    spec.Basic.Publish: 'Bssbb',
+    spec.Basic.Ack: 'Lb',
+    spec.Basic.Reject: 'Lb',
+    spec.Basic.Nack: 'Lbb',
+    spec.Confirm.Select: 'b',
+}
+
+
+class StoredMessage(object):
+
+    def __init__(self, body, properties, exchange="", routing_key="", redelivered=False):
+
+        self.body = body
+        self.properties = properties
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.redelivered = redelivered
+
+
+class BrokerQueue(object):
+
+    def __init__(self, name, arguments):
+
+        self.name = name
+        self.arguments = arguments
+        self.messages = deque()
+        self.consumers = deque()
+
+
+class BrokerConsumer(object):
+
+    def __init__(self, channel, queue, tag, no_ack, prefetch_count, arguments):
+
+        self.channel = channel
+        self.queue = queue
+        self.tag = tag
+        self.no_ack = no_ack
+        self.prefetch_count = prefetch_count
+        self.arguments = arguments
+        self.unacked = 0
+
+    def hasCapacity(self):
+
+        channel = self.channel
+        if self.prefetch_count and self.unacked >= self.prefetch_count:
+            return False
+        if channel.global_prefetch_count and len(channel.unacked) >= channel.global_prefetch_count:
+            return False
+        return channel.session.alive
+
+
+class BrokerChannel(object):
+
+    def __init__(self, session, number):
+
+        self.session = session
+        self.number = number
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        self.next_tag = 1
+        self.unacked = OrderedDict()
+        self.consumers = {}
+        self.publishing = None
+        self.confirming = False
+        self.published = 0
+
+
+class Session(object):
+
+    '''
+    A client connection to the ``Broker``.
+    '''
+
+    def __init__(self, broker, sock):
+
+        self.broker = broker
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = Semaphore()
+        self.channels = {}
+        self.alive = True
+        self.heartbeat = 0
+
+    def readFrame(self):
+
+        header = self.reader.read(7)
+        if len(header) < 7:
+            raise EOFError("Connection closed.")
+        frame_type, channel, size = unpack_from('>BHI', header)
+        payload = self.reader.read(size + 1)
+        if len(payload) < size + 1 or payload[-1:] != FRAME_END:
+            raise EOFError("Invalid frame.")
+        return frame_type, channel, payload[:-1]
+
+    def write(self, data):
+
+        with self.lock:
+            self.sock.sendall(data)
+
+    def frame(self, frame_type, channel, payload):
+
+        return pack('>BHI', frame_type, channel, len(payload)) + payload + FRAME_END
+
+    def sendMethod(self, channel, method, format='', args=(), message=None):
+
+        payload = pack('>HH', *method) + (dumps(format, args) if format else b'')
+        data = [self.frame(1, channel, payload)]
+        if message is not None:
+            body = message.body
+            properties = Message(**message.properties)._serialize_properties()
+            data.append(self.frame(2, channel, pack('>HHQ', method[0], 0, len(body)) + properties))
+            for offset in range(0, len(body), FRAME_MAX - 8):
+                data.append(self.frame(3, channel, body[offset:offset + FRAME_MAX - 8]))
+        self.write(b''.join(data))
+
+
+class Broker(object):
+
+    '''
+    An in-process stand-in for an AMQP 0-9-1 broker.
+
+    It implements just enough of the protocol for
+    ``amqp.connection.Connection`` to declare exchanges and queues, bind
+    them, publish, consume with prefetch limits and acknowledge, reject or
+    nack deliveries, with publisher confirms and mandatory publishing.
+    Queues support the x-message-ttl,
+    x-dead-letter-exchange and x-dead-letter-routing-key arguments.
+    Messages live in memory only.  It is meant to
+    benchmark and exercise ``AMQPIn`` without a real broker.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on.  0 picks a free port.
+
+    Attributes:
+        acknowledged (int): The number of acknowledged deliveries.
+        dead_lettered (int): The number of dead-lettered messages.
+        delivered (int): The number of deliveries.
+        on_deliver (func): Called with each ``StoredMessage`` delivered.
+        rejected (int): The number of deliveries rejected without requeue.
+        requeued (int): The number of deliveries requeued.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0):
+
+        self.server = StreamServer((host, port), self.handle)
+        self.exchanges = {"": "direct"}
+        self.bindings = {}
+        self.queues = {}
+        self.sessions = []
+        self.acknowledged = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.dead_lettered = 0
+        self.requeued = 0
+        self.on_deliver = None
+
+    @property
+    def address(self):
+
+        return "%s:%s" % (self.server.server_host, self.server.server_port)
+
+    def start(self):
+
+        self.server.start()
+
+    def stop(self):
+
+        for session in list(self.sessions):
+            self.disconnect(session)
+        self.server.stop()
+
+    def declareQueue(self, name, arguments=None):
+
+        if name not in self.queues:
+            self.queues[name] = BrokerQueue(name, arguments or {})
+        return self.queues[name]
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        '''
+        Routes a message as if it was published by a client and returns the
+        number of queues it was routed to.
+        '''
+
+        message = StoredMessage(body, dict(properties or {}), exchange, routing_key)
+        queues = self.route(exchange, routing_key)
+        for queue in queues:
+            self.append(queue, message)
+            self.dispatch(queue)
+        return len(queues)
+
+    def append(self, queue, message):
+
+        queue.messages.append(message)
+        if "x-message-ttl" in queue.arguments:
+            spawn_later(queue.arguments["x-message-ttl"] / 1000.0, self.expire, queue, message)
+
+    def expire(self, queue, message):
+
+        if message in queue.messages:
+            queue.messages.remove(message)
+            self.deadLetter(queue, message)
+
+    def deadLetter(self, queue, message):
+
+        if "x-dead-letter-exchange" in queue.arguments:
+            self.dead_lettered += 1
+            self.publish(
+                queue.arguments["x-dead-letter-exchange"],
+                queue.arguments.get("x-dead-letter-routing-key", message.routing_key),
+                message.body,
+                message.properties
+            )
+
+    def enqueue(self, queue, messages):
+        '''
+        Appends ``messages``, a list of (body, properties) tuples, straight
+        to ``queue``.
+        '''
+
+        queue = self.declareQueue(queue)
+        for body, properties in messages:
+            self.append(queue, StoredMessage(body, dict(properties or {}), "", queue.name))
+        self.dispatch(queue)
+
+    def route(self, exchange, routing_key):
+
+        if exchange == "":
+            if routing_key in self.queues:
+                return [self.queues[routing_key]]
+            return []
+        exchange_type = self.exchanges.get(exchange, "direct")
+        result = []
+        for queue, binding_key in self.bindings.get(exchange, []):
+            if exchange_type == "fanout" or binding_key == routing_key or \
+                    (exchange_type == "topic" and self.topicMatch(binding_key, routing_key)):
+                if self.queues[queue] not in result:
+                    result.append(self.queues[queue])
+        return result
+
+    def topicMatch(self, pattern, routing_key):
+
+        def match(words, keys):
+            if not words:
+                return not keys
+            if words[0] == "#":
+                return any(match(words[1:], keys[index:]) for index in range(len(keys) + 1))
+            if not keys:
+                return False
+            return (words[0] == "*" or words[0] == keys[0]) and match(words[1:], keys[1:])
+
+        return match(pattern.split("."), routing_key.split("."))
+
+    def dispatch(self, queue):
+
+        while queue.messages and queue.consumers:
+            for _ in range(len(queue.consumers)):
+                consumer = queue.consumers[0]
+                queue.consumers.rotate(-1)
+                if consumer.hasCapacity():
+                    break
+            else:
+                return
+            self.deliver(consumer, queue.messages.popleft())
+
+    def deliver(self, consumer, message):
+
+        channel = consumer.channel
+        tag = channel.next_tag
+        channel.next_tag += 1
+        if not consumer.no_ack:
+            channel.unacked[tag] = (consumer, message)
+            consumer.unacked += 1
+        self.delivered += 1
+        if self.on_deliver is not None:
+            self.on_deliver(message)
+        try:
+            channel.session.sendMethod(
+                channel.number,
+                spec.Basic.Deliver,
+                'sLbss',
+                (consumer.tag, tag, message.redelivered, message.exchange, message.routing_key),
+                message
+            )
+        except Exception:
+            self.disconnect(channel.session)
+
+    def settle(self, channel, tag, multiple, requeue=None):
+        '''
+        Acknowledges (``requeue`` is None) or rejects deliveries.
+        '''
+
+        if multiple:
+            tags = [t for t in channel.unacked if t <= tag]
+        elif tag in channel.unacked:
+            tags = [tag]
+        else:
+            tags = []
+
+        queues = []
+        for t in reversed(tags):
+            consumer, message = channel.unacked.pop(t)
+            consumer.unacked -= 1
+            if requeue is None:
+                self.acknowledged += 1
+            elif requeue:
+                self.requeued += 1
+                message.redelivered = True
+                consumer.queue.messages.appendleft(message)
+            else:
+                self.rejected += 1
+                self.deadLetter(consumer.queue, message)
+            if consumer.queue not in queues:
+                queues.append(consumer.queue)
+        for queue in queues:
+            self.dispatch(queue)
+
+    def releaseChannel(self, channel):
+
+        for consumer in channel.consumers.values():
+            if consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+        channel.consumers = {}
+        queues = []
+        for tag, (consumer, message) in reversed(list(channel.unacked.items())):
+            message.redelivered = True
+            consumer.queue.messages.appendleft(message)
+            self.requeued += 1
+            if consumer.queue not in queues:
+                queues.append(consumer.queue)
+        channel.unacked.clear()
+        for queue in queues:
+            self.dispatch(queue)
+
+    def disconnect(self, session):
+
+        if not session.alive:
+            return
+        session.alive = False
+        for channel in session.channels.values():
+            self.releaseChannel(channel)
+        session.channels = {}
+        try:
+            session.sock.shutdown(socket.SHUT_RDWR)
+            session.sock.close()
+        except Exception:
+            pass
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def sendHeartbeats(self, session):
+
+        while session.alive and session.heartbeat:
+            sleep(session.heartbeat / 2.0)
+            try:
+                session.write(session.frame(8, 0, b''))
+            except Exception:
+                self.disconnect(session)
+
+    def handle(self, sock, address):
+
+        session = Session(self, sock)
+        self.sessions.append(session)
+        try:
+            if session.reader.read(8) != b'AMQP\x00\x00\x09\x01':
+                return
+            session.sendMethod(
+                0,
+                spec.Connection.Start,
+                'ooFSS',
+                (0, 9, {"product": "wishbone-benchmark-broker", "capabilities": {}}, "PLAIN AMQPLAIN", "en_US")
+            )
+            while session.alive:
+                frame_type, number, payload = session.readFrame()
+                if frame_type == 1:
+                    self.handleMethod(session, number, payload)
+                elif frame_type == 2:
+                    channel = session.channels[number]
+                    channel.publishing[1].inbound_header(payload)
+                    if channel.publishing[1].ready:
+                        self.publishContent(channel)
+                elif frame_type == 3:
+                    channel = session.channels[number]
+                    channel.publishing[1].inbound_body(payload)
+                    if channel.publishing[1].ready:
+                        self.publishContent(channel)
+        except Exception:
+            pass
+        finally:
+            self.disconnect(session)
+
+    def publishContent(self, channel):
+
+        (exchange, routing_key, mandatory), message = channel.publishing
+        channel.publishing = None
+        routed = self.publish(exchange, routing_key, message.body, message.properties)
+        if mandatory and not routed:
+            channel.session.sendMethod(channel.number, spec.Basic.Return, 'Bsss', (312, "NO_ROUTE", exchange, routing_key), message)
+        if channel.confirming:
+            channel.published += 1
+            channel.session.sendMethod(channel.number, spec.Basic.Ack, 'Lb', (channel.published, False))
+
+    def handleMethod(self, session, number, payload):
+
+        method = unpack_from('>HH', payload)
+        args, _ = loads(CLIENT_METHODS[method], payload, 4) if CLIENT_METHODS.get(method) else ([], 4)
+        channel = session.channels.get(number)
+
+        if method == spec.Connection.StartOk:
+            session.sendMethod(0, spec.Connection.Tune, 'BlB', (2047, FRAME_MAX, 0))
+        elif method == spec.Connection.TuneOk:
+            session.heartbeat = args[2]
+            if session.heartbeat:
+                spawn(self.sendHeartbeats, session)
+        elif method == spec.Connection.Open:
+            session.sendMethod(0, spec.Connection.OpenOk, 's', ('',))
+        elif method == spec.Connection.Close:
+            session.sendMethod(0, spec.Connection.CloseOk)
+            self.disconnect(session)
+        elif method == spec.Channel.Open:
+            session.channels[number] = BrokerChannel(session, number)
+            session.sendMethod(number, spec.Channel.OpenOk, 'S', ('',))
+        elif method == spec.Channel.Close:
+            self.releaseChannel(channel)
+            del session.channels[number]
+            session.sendMethod(number, spec.Channel.CloseOk)
+        elif method == spec.Exchange.Declare:
+            self.exchanges[args[1]] = args[2]
+            if not args[7]:
+                session.sendMethod(number, spec.Exchange.DeclareOk)
+        elif method == spec.Queue.Declare:
+            queue = self.declareQueue(args[1], args[7])
+            if not args[6]:
+                session.sendMethod(number, spec.Queue.DeclareOk, 'sll', (queue.name, len(queue.messages), len(queue.consumers)))
+        elif method == spec.Queue.Bind:
+            self.bindings.setdefault(args[2], [])
+            if (args[1], args[3]) not in self.bindings[args[2]]:
+                self.bindings[args[2]].append((args[1], args[3]))
+            if not args[4]:
+                session.sendMethod(number, spec.Queue.BindOk)
+        elif method == spec.Basic.Qos:
+            if args[2]:
+                channel.global_prefetch_count = args[1]
+            else:
+                channel.prefetch_count = args[1]
+            session.sendMethod(number, spec.Basic.QosOk)
+            for consumer in channel.consumers.values():
+                self.dispatch(consumer.queue)
+        elif method == spec.Basic.Consume:
+            queue = self.declareQueue(args[1])
+            tag = args[2] or "ctag-%s-%s" % (number, len(channel.consumers) + 1)
+            consumer = BrokerConsumer(channel, queue, tag, args[4], channel.prefetch_count, args[7])
+            channel.consumers[tag] = consumer
+            queue.consumers.append(consumer)
+            if not args[6]:
+                session.sendMethod(number, spec.Basic.ConsumeOk, 's', (tag,))
+            self.dispatch(queue)
+        elif method == spec.Basic.Cancel:
+            consumer = channel.consumers.pop(args[0], None)
+            if consumer is not None and consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+            if not args[1]:
+                session.sendMethod(number, spec.Basic.CancelOk, 's', (args[0],))
+        elif method == spec.Basic.Publish:
+            channel.publishing = ((args[1], args[2], args[3]), Message())
+        elif method == spec.Basic.Ack:
+            self.settle(channel, args[0], args[1])
+        elif method == spec.Basic.Reject:
+            self.settle(channel, args[0], False, args[1])
+        elif method == spec.Basic.Nack:
+            self.settle(channel, args[0], args[1], args[2])
+        elif method == spec.Confirm.Select:
+            channel.confirming = True
+            if not args[0]:
+                session.sendMethod(number, spec.Confirm.SelectOk)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  native.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+'''
+Compares the cost of turning a received native Wishbone event into an
+``Event`` instance:
+
+    - json+slurp: JSON decoding followed by ``Event().slurp()``, the path
+      Wishbone takes with a JSON protocol decoder
+    - msgpack+slurp: msgpack decoding followed by ``Event().slurp()``
+    - msgpack+buildEvent: msgpack decoding followed by the fast path of
+      ``wishbone_input_amqp.native.buildEvent``
+
+Usage:
+
+    python benchmarks/native.py --events 100000
+'''
+
+from time import time
+from wishbone.event import Event
+from wishbone_input_amqp.native import buildEvent
+import argparse
+import json
+import msgpack
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+def measure(function, bodies):
+
+    start = time()
+    for body in bodies:
+        function(body)
+    return len(bodies) / (time() - start)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks native event deserialization.")
+    parser.add_argument("--events", type=int, default=100000, help="The number of events to deserialize.")
+    args = parser.parse_args()
+
+    event = Event({"host": "server01", "metric": "cpu.load", "value": 0.75, "tags": ["a", "b"]})
+    event.data["tags"].append("production")
+    native = event.dump()
+    json_bodies = [json.dumps(native).encode("utf-8")] * args.events
+    msgpack_bodies = [msgpack.packb(native, use_bin_type=True)] * args.events
+
+    results = [
+        ("json+slurp", measure(lambda body: Event().slurp(json.loads(body)), json_bodies)),
+        ("msgpack+slurp", measure(lambda body: Event().slurp(msgpack.unpackb(body, raw=False)), msgpack_bodies)),
+        ("msgpack+buildEvent", measure(lambda body: buildEvent(msgpack.unpackb(body, raw=False)), msgpack_bodies))
+    ]
+
+    print("%20s %12s" % ("path", "events/s"))
+    print("-" * 33)
+    for name, rate in results:
+        print("%20s %12.0f" % (name, rate))
+
+
+if __name__ == '__main__':
+    main()
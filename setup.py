@@ -76,6 +76,9 @@ setup(
                  ],
     extras_require={
         'testing': ['pytest'],
+        'msgpack': ['msgpack>=0.5.2'],
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
     },
     platforms=['Linux'],
     test_suite='tests.test_wishbone',
@@ -27,6 +27,7 @@ from gevent import monkey; monkey.patch_all()
 from wishbone.actor import ActorConfig
 from wishbone.utils.test import getter
 from wishbone.event import Event
+from wishbone.error import InvalidData, ModuleInitFailure
 
 from wishbone_input_amqp import AMQPIn
 from amqp.connection import Connection
@@ -35,6 +36,18 @@ from gevent import sleep
 import requests
 from requests.auth import HTTPBasicAuth
 from amqp import Connection, basic_message
+from wishbone_input_amqp.capture import CaptureReader, CaptureWriter
+from wishbone_input_amqp.compression import DecompressionError, decompress
+from wishbone_input_amqp.dedup import DeduplicationCache
+from wishbone_input_amqp.delivery import DeliveryTracker
+from wishbone_input_amqp.native import buildEvent
+from wishbone_input_amqp.routing import TopicMatcher
+from collections import OrderedDict
+from datetime import datetime, timezone
+import json
+import os
+import pytest
+import zlib
 
 
 def test_module_amqp_create_exchange_default():
@@ -197,3 +210,424 @@ def test_module_amqp_submit_message():
     assert event.get() == "test"
     amqp.stop()
 
+
+def test_module_amqp_ack_batch():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, exchange="wishbone_ack_batch", queue="wishbone_ack_batch", prefetch_count=10, ack_batch_size=3)
+
+    amqp.pool.queue.outbox.disableFallThrough()
+    amqp.start()
+
+    sleep(1)
+    conn = Connection()
+    conn.connect()
+    channel = conn.channel()
+    for _ in range(3):
+        channel.basic_publish(basic_message.Message("test"), exchange="wishbone_ack_batch")
+    channel.close()
+    conn.close()
+    sleep(1)
+    for _ in range(3):
+        amqp.pool.queue.ack.put(getter(amqp.pool.queue.outbox))
+    sleep(6)
+    response = requests.get("http://localhost:15672/api/queues/%2f/wishbone_ack_batch", auth=HTTPBasicAuth("guest", "guest"))
+    assert response.json()["messages_unacknowledged"] == 0
+    amqp.stop()
+
+
+def test_module_amqp_batch_split_cancel():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, exchange="wishbone_batch_split", queue="wishbone_batch_split", body_delimiter="\n", event_batch_size=2, event_batch_interval=0.1)
+
+    amqp.pool.queue.outbox.disableFallThrough()
+    amqp.pool.queue.cancel.disableFallThrough()
+    amqp.start()
+
+    sleep(1)
+    conn = Connection()
+    conn.connect()
+    channel = conn.channel()
+    channel.basic_publish(basic_message.Message("r1\nr2\nr3"), exchange="wishbone_batch_split")
+    channel.close()
+    conn.close()
+
+    first = getter(amqp.pool.queue.outbox)
+    second = getter(amqp.pool.queue.outbox)
+    assert first.get() == ["r1", "r2"]
+    assert second.get() == ["r3"]
+    amqp.pool.queue.ack.put(first)
+    amqp.pool.queue.cancel.put(second)
+
+    event = getter(amqp.pool.queue.outbox)
+    assert event.get() == ["r1", "r2"]
+    assert event.get("tmp.amqp.delivery_tag") == 2
+    amqp.stop()
+
+
+def test_module_amqp_bindings():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, exchange="wishbone_bindings", exchange_type="topic", bindings=[
+        {"queue": "wishbone_binding_a", "routing_keys": ["a.#"]},
+        {"queue": "wishbone_binding_b", "routing_keys": ["b.#"]}
+    ])
+
+    amqp.pool.queue.outbox.disableFallThrough()
+    amqp.start()
+
+    sleep(1)
+    conn = Connection()
+    conn.connect()
+    channel = conn.channel()
+    channel.basic_publish(basic_message.Message("test"), exchange="wishbone_bindings", routing_key="b.test")
+    channel.close()
+    conn.close()
+    sleep(1)
+    event = getter(amqp.pool.queue.outbox)
+    assert event.get() == "test"
+    assert event.get("tmp.amqp.queue") == "wishbone_binding_b"
+    amqp.stop()
+
+
+def test_module_amqp_capture_replay(tmp_path):
+
+    capture = str(tmp_path / "wishbone_capture")
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, exchange="wishbone_capture", queue="wishbone_capture", capture=capture)
+
+    amqp.pool.queue.outbox.disableFallThrough()
+    amqp.start()
+
+    sleep(1)
+    conn = Connection()
+    conn.connect()
+    channel = conn.channel()
+    channel.basic_publish(basic_message.Message("test"), exchange="wishbone_capture")
+    channel.close()
+    conn.close()
+    sleep(1)
+    amqp.pool.queue.ack.put(getter(amqp.pool.queue.outbox))
+    amqp.stop()
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, queue="wishbone_capture", replay=capture, replay_speed=0)
+
+    amqp.pool.queue.outbox.disableFallThrough()
+    amqp.start()
+
+    event = getter(amqp.pool.queue.outbox)
+    assert event.get() == "test"
+    assert event.get("tmp.amqp.queue") == "wishbone_capture"
+    amqp.stop()
+
+
+def test_module_amqp_metadata():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, exchange="wishbone_metadata", queue="wishbone_metadata",
+                  metadata={"message_id": "message_id", "headers.trace_id": "trace_id"})
+
+    amqp.pool.queue.outbox.disableFallThrough()
+    amqp.start()
+
+    sleep(1)
+    conn = Connection()
+    conn.connect()
+    channel = conn.channel()
+    channel.basic_publish(basic_message.Message("test", message_id="one", application_headers={"trace_id": "abc"}), exchange="wishbone_metadata")
+    channel.close()
+    conn.close()
+
+    event = getter(amqp.pool.queue.outbox)
+    assert event.get("tmp.amqp.message_id") == "one"
+    assert event.get("tmp.amqp.trace_id") == "abc"
+    assert event.get("tmp.amqp.queue") == "wishbone_metadata"
+    amqp.stop()
+
+
+def test_decompress_max_size():
+
+    body = zlib.compress(b"x" * 1000)
+    assert decompress("zlib", body, 1000) == b"x" * 1000
+    with pytest.raises(DecompressionError):
+        decompress("zlib", body, 999)
+
+
+def test_decompress_truncated():
+
+    body = zlib.compress(b"x" * 1000)
+    with pytest.raises(DecompressionError):
+        decompress("zlib", body[:-4], 1000)
+
+
+def test_decompress_zstd():
+
+    zstandard = pytest.importorskip("zstandard")
+    compressor = zstandard.ZstdCompressor()
+    body = compressor.compress(b"a" * 1000) + compressor.compress(b"b" * 1000)
+    assert decompress("zstd", body, 2000) == b"a" * 1000 + b"b" * 1000
+    with pytest.raises(DecompressionError):
+        decompress("zstd", body, 1999)
+    with pytest.raises(DecompressionError):
+        decompress("zstd", body[:-4], 2000)
+
+
+class RecordingChannel(object):
+
+    def __init__(self):
+
+        self.frames = []
+
+    def basic_ack(self, tag, multiple=False):
+
+        self.frames.append(("ack", tag, multiple))
+
+    def basic_cancel(self, consumer_tag, nowait=False):
+
+        self.frames.append(("cancel", consumer_tag, nowait))
+
+    def basic_reject(self, tag, requeue):
+
+        self.frames.append(("reject", tag, requeue))
+
+    def send_method(self, method, format, args):
+
+        self.frames.append(("nack", args[0], args[2]))
+
+
+def test_delivery_tracker_coalesce():
+
+    channel = RecordingChannel()
+    tracker = DeliveryTracker(channel)
+    for tag in range(1, 7):
+        tracker.deliver(tag)
+    tracker.ack(2)
+    tracker.ack(1)
+    tracker.nack(3)
+    tracker.ack(4)
+    tracker.ack(6)
+    assert tracker.pending == 1
+    assert tracker.settled == 5
+    tracker.flush()
+    assert channel.frames == [("ack", 2, True), ("nack", 3, True), ("ack", 4, True), ("ack", 6, False)]
+    assert tracker.lowestPending() == 5
+
+    tracker.ack(6)
+    tracker.ack(5)
+    tracker.flush()
+    assert channel.frames[4:] == [("ack", 5, True)]
+    assert tracker.pending == 0
+    assert tracker.lowestPending() == 7
+
+
+def test_delivery_tracker_reject():
+
+    channel = RecordingChannel()
+    tracker = DeliveryTracker(channel)
+    for tag in (1, 2, 3):
+        tracker.deliver(tag)
+    tracker.reject(1)
+    tracker.reject(2)
+    tracker.reject(3)
+    tracker.flush()
+    assert channel.frames == [("nack", 3, False)]
+
+    tracker.deliver(4)
+    tracker.deliver(5)
+    tracker.reject(5)
+    tracker.flush()
+    assert channel.frames[-1] == ("reject", 5, False)
+
+
+def test_topic_matcher_star():
+
+    matcher = TopicMatcher({"*.error": "start", "logs.*.error": "middle", "logs.*": "end"}, default=("outbox",))
+    assert matcher.match("app.error") == ("start",)
+    assert matcher.match("logs.app.error") == ("middle",)
+    assert matcher.match("logs.app") == ("end",)
+    assert matcher.match("logs") == ("outbox",)
+    assert matcher.match("logs.app.db.error") == ("outbox",)
+
+
+def test_topic_matcher_hash():
+
+    matcher = TopicMatcher({"#.error": "start", "logs.#.error": "middle", "logs.#": "end"}, default=("outbox",))
+    assert matcher.match("error") == ("start",)
+    assert set(matcher.match("logs.error")) == set(["start", "middle", "end"])
+    assert set(matcher.match("logs.app.db.error")) == set(["start", "middle", "end"])
+    assert matcher.match("logs") == ("end",)
+    assert matcher.match("metrics.cpu") == ("outbox",)
+
+
+def test_topic_matcher_targets():
+
+    matcher = TopicMatcher({"metrics.*": ["metrics", "archive"], "#": "archive"})
+    assert set(matcher.match("metrics.cpu")) == set(["metrics", "archive"])
+    assert len(matcher.match("metrics.cpu")) == 2
+    assert matcher.match("logs") == ("archive",)
+
+
+def test_topic_matcher_cache():
+
+    matcher = TopicMatcher({"a.*": "a"}, default=("outbox",), cache_size=2)
+    assert matcher.match("a.1") == ("a",)
+    assert matcher.match("a.2") == ("a",)
+    assert len(matcher.cache) == 2
+    assert matcher.match("b.1") == ("outbox",)
+    assert list(matcher.cache) == ["b.1"]
+    assert matcher.match("a.1") == ("a",)
+
+
+def test_module_amqp_engine():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    assert AMQPIn(actor_config, engine="none").kwargs.engine == "none"
+    with pytest.raises(ModuleInitFailure):
+        AMQPIn(actor_config, engine="asyncio")
+
+
+def test_module_amqp_routes_reserved():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    assert AMQPIn(actor_config, routes={"#": ["outbox", "logs"]}).outputs == ["outbox", "logs"]
+    for target in ("ack", "cancel", "_logs", "_metrics"):
+        with pytest.raises(ModuleInitFailure):
+            AMQPIn(actor_config, routes={"a.#": "logs", "#": ["archive", target]})
+
+
+def test_capture_content_encoding(tmp_path):
+
+    capture = str(tmp_path / "capture")
+    writer = CaptureWriter(capture)
+    for body, encoding in (("caf\xe9", "latin-1"), ("caf\xe9", "utf-16"), ("caf\xe9", "utf-8")):
+        message = basic_message.Message(body, content_encoding=encoding)
+        message.delivery_info = {"exchange": "", "routing_key": "q"}
+        writer.write("q", message, 1.0)
+    writer.close()
+
+    assert [message.body for _, _, message in CaptureReader(capture)] == ["caf\xe9"] * 3
+    assert [message.body_size for _, _, message in CaptureReader(capture)] == [4, 10, 5]
+
+
+def test_delivery_tracker_expire():
+
+    channel = RecordingChannel()
+    tracker = DeliveryTracker(channel)
+    tracker.deliver(1, 10)
+    tracker.deliver(2, 20)
+    tracker.ack(1)
+    assert tracker.expire(0) == 0
+    assert tracker.expire(float("inf")) == 1
+    assert tracker.pending == 0
+    assert tracker.bytes == 0
+    assert not tracker.ack(2)
+    tracker.flush()
+    assert channel.frames == [("ack", 1, True), ("nack", 2, True)]
+
+
+def test_module_amqp_stale_acknowledgement():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config)
+    channel = RecordingChannel()
+    amqp.consumers[0].tracker = DeliveryTracker(channel, generation=2)
+    amqp.consumers[0].tracker.deliver(1)
+
+    event = Event("test")
+    event.set({"delivery_tag": 1, "channel": 0, "generation": 1}, "tmp.amqp")
+    amqp.acknowledge(event)
+    assert amqp.metrics.stale == 1
+    assert amqp.consumers[0].tracker.pending == 1
+
+    event.set(2, "tmp.amqp.generation")
+    amqp.acknowledge(event)
+    assert amqp.consumers[0].tracker.pending == 0
+    assert channel.frames == [("ack", 1, True)]
+
+
+def test_build_event_native():
+
+    native = Event({"one": 1}).dump()
+    event = buildEvent(native)
+    assert event.data.data is native
+    assert event.get() == {"one": 1}
+
+
+def test_build_event_slurp():
+
+    native = OrderedDict(Event({"one": 1}).dump())
+    event = buildEvent(native)
+    assert event.get() == {"one": 1}
+
+    with pytest.raises(InvalidData):
+        buildEvent({"data": {"one": 1}})
+
+
+def test_deduplication_cache():
+
+    cache = DeduplicationCache(size=2)
+    assert not cache.seen("a")
+    cache.add("a")
+    cache.add("b")
+    assert cache.seen("a")
+    cache.add("c")
+    assert not cache.seen("b")
+    assert cache.seen("a")
+    assert cache.seen("c")
+    cache.discard("a")
+    assert not cache.seen("a")
+
+
+def test_deduplication_cache_ttl():
+
+    cache = DeduplicationCache(size=10, ttl=60)
+    cache.add("old")
+    cache.add("new")
+    cache.keys["old"] -= 120
+    assert cache.seen("new")
+    assert not cache.seen("old")
+    assert list(cache.keys) == ["new"]
+
+
+def test_module_amqp_stream_offset():
+
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, stream_offset="first", queue_durable=True, queue_auto_delete=False)
+    assert amqp.getStreamOffset("wishbone") == "first"
+    amqp.kwargs.stream_offset = "100"
+    assert amqp.getStreamOffset("wishbone") == 100
+    amqp.kwargs.stream_offset = "timestamp:1700000000"
+    assert amqp.getStreamOffset("wishbone") == datetime.fromtimestamp(1700000000, timezone.utc)
+    amqp.offsets = {"wishbone": 42}
+    assert amqp.getStreamOffset("wishbone") == 42
+
+
+def test_module_amqp_save_offsets(tmp_path):
+
+    checkpoint = str(tmp_path / "offsets.json")
+    actor_config = ActorConfig('amqp', 100, 1, {}, "", disable_exception_handling=True)
+    amqp = AMQPIn(actor_config, stream_offset="first", stream_checkpoint=checkpoint, queue_durable=True, queue_auto_delete=False)
+    consumer = amqp.consumers[0]
+    consumer.link.connected = True
+    consumer.channel = RecordingChannel()
+    consumer.tracker = DeliveryTracker(consumer.channel)
+    for tag in range(1, 4):
+        consumer.tracker.deliver(tag)
+        consumer.offsets[tag] = 99 + tag
+
+    amqp.saveOffsets()
+    assert not os.path.exists(checkpoint)
+
+    consumer.tracker.ack(1)
+    amqp.saveOffsets()
+    with open(checkpoint) as f:
+        assert json.load(f) == {"wishbone": 101}
+    assert amqp.loadOffsets() == {"wishbone": 101}
+
+    amqp.postHook()
+    with open(checkpoint) as f:
+        assert json.load(f) == {"wishbone": 101}
+    assert consumer.channel.frames[-1] == ("nack", 3, True)
@@ -22,11 +22,39 @@
 #
 #
 
-from gevent import monkey
-monkey.patch_all()
 from wishbone.module import InputModule
 from amqp.connection import Connection as amqp_connection
-from gevent import sleep
+from amqp.basic_message import Message
+from gevent import get_hub, monkey, sleep, socket
+from functools import partial
+from collections import deque
+from time import monotonic, time
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+import random
+from .compression import CODECS, DecompressionError, decompress
+from .capture import CaptureReader, CaptureWriter, ReplayChannel
+from .consumer import Binding, Consumer, Link
+from .dedup import DeduplicationCache
+from .routing import TopicMatcher
+from .delivery import ACK, NACK, DeliveryTracker
+from .metrics import Metrics
+from .native import MsgpackDecoder, buildEvent, msgpack
+from wishbone.event import Event as Wishbone_Event
+from wishbone.error import ModuleInitFailure, QueueEmpty
+
+ORIGIN_HEADERS = {
+    "exchange": "x-original-exchange",
+    "routing_key": "x-original-routing-key"
+}
+
+METADATA_SOURCES = dict(
+    [(name, "delivery_info") for name in ("consumer_tag", "redelivered")] +
+    [(name, "origin") for name in ORIGIN_HEADERS] +
+    [(name, "properties") for name, _ in Message.PROPERTIES if name != "application_headers"]
+)
 
 
 class AMQPIn(InputModule):
@@ -36,8 +64,200 @@ class AMQPIn(InputModule):
     Consumes messages from an AMQP message broker.
     The declared <exchange> and <queue> will be bound to each other.
 
+    Acknowledgements are coalesced per channel. Acknowledged delivery tags
+    forming a contiguous range are settled with a single basic_ack (or
+    basic_nack for cancelled messages) with the multiple flag set.
+
+    Acknowledgements and cancellations of messages delivered on a channel
+    which has been closed since, for example after a reconnect, are dropped
+    as the broker already requeued those messages.
+
+    Multiple queues can be consumed over the same connections by defining
+    <bindings>. Each binding is a dict which accepts the queue_*, exchange_*
+    and prefetch_count parameters of this module plus <queue> and
+    <routing_keys>.  Parameters omitted from a binding default to the module
+    values.  When <bindings> is empty the module parameters define the one
+    and only binding.
+
+    <consumers> channels per binding are spread over <connections> connections.
+    Each connection is drained by its own greenlet and all consumers submit
+    to the same outbox.
+
+    <routes> maps AMQP topic patterns to queues of this module which are
+    created on the fly.  Events are submitted directly to the queues of all
+    patterns matching the routing key of their message, or to outbox when
+    none matches.  Each queue beyond the first receives a copy of the event.
+    The message is acknowledged once all copies are acknowledged and
+    cancelled when any of them is cancelled.  Batched events are always
+    submitted to outbox.
+
+    When the outbox, or any routed queue, fills up to
+    <outbox_high_watermark> all consumers are cancelled until they drained
+    to <outbox_low_watermark>.  Frames and heartbeats keep being processed
+    in the meantime.  Heartbeats are sent from a separate greenlet so they
+    also go out while submitting an event blocks.  Messages still arriving
+    when the outbox is full are held back instead of blocking the
+    connection.
+
+    When <prefetch_bytes> is set, the body sizes of the messages in flight
+    are accounted for and all consumers are cancelled as soon as they add
+    up to <prefetch_bytes>.  Consumption resumes once acknowledgements,
+    cancellations, rejections and expiries released them down to
+    <prefetch_bytes> * <outbox_low_watermark>.  This bounds the memory held
+    by messages of very different sizes where <prefetch_count> alone
+    cannot.
+
+    On shutdown the consumers are cancelled first.  Acknowledgements and
+    cancellations keep being processed for up to <shutdown_timeout> seconds
+    or until no message is in flight anymore.  The remaining messages are
+    then rejected and requeued in bulk before the connections are closed.
+
+    <metadata> copies AMQP metadata into the events of a message.  It maps
+    each source to the key under tmp.<name> to store it in.  Sources are
+    the delivery fields routing_key, exchange, redelivered and
+    consumer_tag, the message properties such as message_id,
+    correlation_id, timestamp or app_id, the headers table as a whole as
+    "headers" or a single header as "headers.<name>".  Metadata a message
+    does not carry is not set.  The sources are resolved once at startup,
+    the metadata is extracted once per message and the headers table is
+    stored without being copied.
+
+    Besides the queue metrics, the module submits metrics about deliveries,
+    received bytes, redeliveries, decode time, acknowledgement latency,
+    messages and bytes in flight, reconnects and time spent blocked on a
+    full queue to the _metrics queue under module.<name>.amqp.*
+
+    Bodies compressed with one of the codecs gzip, deflate, zlib, lz4 or
+    zstd, as announced by their content_encoding property or assumed by
+    <compression>, are decompressed before decoding.  Bodies which cannot be
+    decompressed or exceed <decompress_max_size> are rejected without
+    requeueing so they end up in the dead letter exchange of the queue if
+    any.  lz4 and zstd require the lz4 and zstandard packages.
+
+    When <retry_attempts> is set, cancelled messages are not requeued at the
+    head of their queue.  Instead they are republished to a delay queue
+    named <queue>.retry.<milliseconds> from which they are dead-lettered
+    back to <queue> after <retry_delay> seconds, doubling with each attempt.
+    The attempts are counted in the x-retry-attempts header and the
+    original exchange and routing key are kept in the x-original-exchange
+    and x-original-routing-key headers, which take precedence over those
+    of the delivery for routing and metadata.  The channel is put in
+    publisher confirm mode and the message is only acknowledged once the
+    broker confirmed its republished copy.  It is requeued instead when the
+    copy is refused or returned because the delay queue does not exist.
+    Once exhausted, the message is rejected without requeueing so it ends
+    up in the dead letter exchange defined by the x-dead-letter-exchange
+    <queue_arguments> if any.  The messages are kept in memory until
+    settled.
+
+    RabbitMQ stream queues are consumed from <stream_offset> when it is set.
+    The queue is declared with the x-queue-type stream argument and has to
+    be durable, not auto deleted and not exclusive.  The offset following
+    the last acknowledged message of each queue is periodically saved to
+    <stream_checkpoint>.  Consumption resumes from the saved offset after a
+    reconnect or restart.  A consumer paused on the same channel resumes
+    from the message following the last one delivered.  Streams are not
+    consumed destructively so use a single consumer per stream.
+
+    Redelivered messages can be deduplicated on a <dedup_key>.  A message
+    flagged redelivered with a key received before is acknowledged and
+    dropped instead of being submitted again.  The key of a cancelled or
+    expired message is forgotten so its redelivery is processed.
+
+    Raw deliveries can be appended to a <capture> file.  A capture file
+    passed to <replay> is fed through the same decode and submit path
+    instead of consuming from a broker, which makes it possible to
+    reproduce production traffic offline.
+
     Parameters:
 
+        - ack_batch_interval(float)(1)
+           |  The max number of seconds acknowledgements are held back
+           |  before being flushed to the broker.
+
+        - ack_batch_size(int)(1)
+           |  The number of acknowledgements and cancellations to collect
+           |  before flushing them to the broker.
+           |  1 flushes each acknowledgement immediately.
+
+        - ack_timeout(float)(0)
+           |  The max number of seconds a message can remain unacknowledged.
+           |  Expired messages are rejected and requeued and their later
+           |  acknowledgement or cancellation is ignored.
+           |  0 disables expiring messages.
+
+        - bindings(list)([])
+           |  A list of dicts, each defining a queue to consume and the exchange
+           |  and routing keys to bind it to.
+           |  For example: [{"queue": "a", "exchange": "logs", "routing_keys": ["a.#"]}]
+
+        - body_delimiter(str)(None)
+           |  Splits message bodies on <body_delimiter> and decodes each record
+           |  on its own.  Records are sliced lazily from the received body so
+           |  large batched payloads such as newline delimited JSON do not get
+           |  copied or buffered by the decoder as a whole.
+           |  None decodes each body as a whole.
+
+        - capture(str)(None)
+           |  The file to append all raw deliveries (body, properties, headers,
+           |  exchange and routing key) to.
+           |  None disables capturing.
+
+        - compression(str)(None)
+           |  The codec to decompress bodies with when their content_encoding
+           |  property does not name a supported codec.
+           |  (gzip, deflate, zlib, lz4, zstd)
+           |  None only decompresses bodies announcing their codec.
+
+        - connections(int)(1)
+           |  The number of connections to spread the consumers over.
+
+        - consumers(int)(1)
+           |  The number of channels consuming each queue in parallel.
+           |  Each channel has its own prefetch window.
+
+        - decompress_max_size(int)(104857600)
+           |  The max number of bytes a body may decompress to.
+
+        - decompress_threshold(int)(1048576)
+           |  Compressed bodies larger than this number of bytes are
+           |  decompressed in a thread so the other consumers keep running.
+
+        - dedup_key(str)(None)
+           |  The key identifying duplicate messages.
+           |  "message_id" uses the message_id property, "headers.<name>" the
+           |  header <name> and "body" a hash of the body.
+           |  None disables deduplication.
+
+        - dedup_size(int)(100000)
+           |  The max number of keys to remember.  The least recently seen
+           |  keys are forgotten first.
+
+        - dedup_ttl(float)(0)
+           |  The number of seconds to remember a key.
+           |  0 remembers keys until they are evicted.
+
+        - engine(str)("gevent")
+           |  How the module gets cooperative sockets.
+           |  gevent: Monkey patches the process with gevent when the module
+           |  is initialized unless the socket module is patched already.
+           |  none: Never patches.  The hosting process has to provide
+           |  patched sockets, otherwise reading from the broker blocks all
+           |  other greenlets.
+           |  Importing the module never patches.
+
+        - event_batch_size(int)(1)
+           |  The number of decoded items to collect into one event carrying
+           |  the list of items.  A message whose items end up in several
+           |  events is acknowledged once all of them are acknowledged and
+           |  cancelled when any of them is cancelled.
+           |  1 submits an event per item.
+           |  Ignored when <native_events> is enabled.
+
+        - event_batch_interval(float)(1)
+           |  The max number of seconds to collect items before submitting an
+           |  incomplete batch.
+
         - exchange(str)("")
            |  The exchange to declare.
 
@@ -59,30 +279,77 @@ class AMQPIn(InputModule):
 
         - heartbeat(int)(0)
             | Enable AMQP heartbeat. The value is the interval in seconds.
+            | A connection which received nothing from the broker for two
+            | intervals is considered dead and reconnected.
             | 0 disables heartbeat support.
 
-        - host(str)("localhost")
+        - host(str/list)("localhost")
            | The host to connect to.
+           | A list of hosts defines the nodes of a broker cluster to fail over
+           | to. Each host can be in "host:port" format.
+
+        - host_selection(str)("round-robin")
+           | The order in which to connect to the hosts.
+           | (round-robin, random, prefer-local)
 
         - interval(float)(1)
            |  The interval in seconds between each generated event.
            |  A value of 0 means as fast as possible.
 
+        - metadata(dict)({})
+           |  Maps AMQP metadata sources to the keys under tmp.<name> to
+           |  store them in. For example {"routing_key": "routing_key",
+           |  "headers.trace_id": "trace_id"}
+
         - native_events(bool)(False)
            |  Whether to expect incoming events to be native Wishbone events
+           |  Unless the actor defines a protocol decoder, native events are
+           |  expected to be msgpack encoded (requires the msgpack package).
+           |  Native events are wrapped as is without being decoded and
+           |  copied into a new event first.
 
         - no_ack(bool)(false)
            |  Override acknowledgement requirement.
 
+        - outbox_high_watermark(float)(0.9)
+           |  The outbox (or routed queue) fill ratio at which consumption
+           |  is paused.
+           |  0 disables pausing.
+
+        - outbox_low_watermark(float)(0.5)
+           |  The outbox (and routed queues) fill ratio at which paused
+           |  consumption resumes.
+
         - password(str)("guest")
            |  The password to authenticate.
 
         - port(int)(5672)
-           | The port to connect to.
+           | The port to connect to when a host defines none.
+
+        - prefetch_adaptive(bool)(false)
+           |  Adjusts the prefetch count of each consumer at runtime within
+           |  <prefetch_min> and <prefetch_max> based on the outbox fill level
+           |  and the acknowledgement latency. <prefetch_count> is the initial
+           |  value. Requires a broker supporting per channel prefetch limits
+           |  such as RabbitMQ.
+
+        - prefetch_adaptive_interval(float)(1)
+           |  The interval in seconds to adjust the prefetch count.
+
+        - prefetch_bytes(int)(0)
+           |  The max number of body bytes in flight before consumption is
+           |  paused.
+           |  0 disables the limit.
 
         - prefetch_count(int)(1)
            |  Prefetch count value to consume messages from queue.
 
+        - prefetch_max(int)(1000)
+           |  The max prefetch count when <prefetch_adaptive> is enabled.
+
+        - prefetch_min(int)(1)
+           |  The min prefetch count when <prefetch_adaptive> is enabled.
+
         - queue(str)("wishbone")
            |  The queue to declare and ultimately consume.
 
@@ -101,14 +368,64 @@ class AMQPIn(InputModule):
         - queue_exclusive(bool)(false)
            |  Declare an exclusive queue.
 
+        - reconnect_backoff(float)(1)
+           |  The seconds to wait before retrying when no broker accepts a connection.
+           |  The delay doubles after each failed round and is jittered.
+
+        - reconnect_backoff_max(float)(60)
+           |  The max number of seconds to wait between connection attempts.
+
+        - replay(str)(None)
+           |  The capture file to replay instead of connecting to a broker.
+           |  Acknowledgements of replayed messages are discarded.
+           |  None consumes from the broker.
+
+        - replay_speed(float)(1)
+           |  The pace to replay <replay> at relative to the original pace.
+           |  0 replays as fast as possible.
+
+        - retry_attempts(int)(0)
+           |  The number of times to retry a cancelled message after a delay.
+           |  0 requeues cancelled messages immediately.
+
+        - retry_delay(float)(1)
+           |  The number of seconds to delay the first retry.
+
+        - retry_delay_max(float)(3600)
+           |  The max number of seconds to delay a retry.
+
+        - routes(dict)({})
+           |  Topic patterns ("*" matches one word, "#" zero or more) mapped
+           |  to the name or list of names of the queues to submit the
+           |  events of matching messages to.  The ack, cancel, _failed,
+           |  _logs, _metrics and _success queues cannot be used.
+           |  For example: {"logs.#": "logs", "metrics.*": ["metrics", "archive"]}
+
         - routing_key(str)("")
            |  The routing key to use in case of a "topic" exchange.
            | When the exchange is type "direct" the routing key is always equal
            | to the <queue> value.
 
+        - shutdown_timeout(float)(0)
+           |  The max number of seconds to wait for the acknowledgement of
+           |  messages in flight when shutting down.
+
         - ssl(bool)(False)
            |  If True expects SSL
 
+        - stream_checkpoint(str)(None)
+           |  The file to save the offsets of consumed streams to.
+           |  None keeps the offsets in memory only.
+
+        - stream_checkpoint_interval(float)(5)
+           |  The interval in seconds to save the stream offsets.
+
+        - stream_offset(str/int)(None)
+           |  The offset to start consuming a stream queue from when no
+           |  checkpoint is available.  (first, last, next, a numeric offset,
+           |  timestamp:<unix time> or an interval such as 1h)
+           |  None consumes a classic queue.
+
         - user(str)("guest")
            |  The username to authenticate.
 
@@ -120,6 +437,11 @@ class AMQPIn(InputModule):
 
         - outbox
            |  Messages coming from the defined broker.
+           |  The queue a message was consumed from is stored in tmp.<name>.queue
+           |  Batched events store their delivery tags in tmp.<name>.delivery_tags
+
+        - <routes>
+           |  Messages with a routing key matching a pattern of <routes>.
 
         - ack
            |  Messages to acknowledge (requires the delivery_tag)
@@ -134,144 +456,1260 @@ class AMQPIn(InputModule):
                  exchange_arguments={},
                  queue="wishbone", queue_durable=False, queue_exclusive=False, queue_auto_delete=True, queue_declare=True,
                  queue_arguments={},
-                 routing_key="", prefetch_count=1, no_ack=False):
+                 routing_key="", prefetch_count=1, no_ack=False,
+                 ack_batch_size=1, ack_batch_interval=1, ack_timeout=0, consumers=1, connections=1, bindings=[],
+                 host_selection="round-robin", reconnect_backoff=1, reconnect_backoff_max=60,
+                 prefetch_adaptive=False, prefetch_adaptive_interval=1, prefetch_min=1, prefetch_max=1000,
+                 outbox_high_watermark=0.9, outbox_low_watermark=0.5, body_delimiter=None,
+                 event_batch_size=1, event_batch_interval=1, capture=None, replay=None, replay_speed=1,
+                 compression=None, decompress_max_size=104857600, decompress_threshold=1048576,
+                 dedup_key=None, dedup_size=100000, dedup_ttl=0,
+                 retry_attempts=0, retry_delay=1, retry_delay_max=3600,
+                 stream_offset=None, stream_checkpoint=None, stream_checkpoint_interval=5,
+                 shutdown_timeout=0, routes={}, prefetch_bytes=0, metadata={}, engine="gevent"):
+        if engine not in ("gevent", "none"):
+            raise ModuleInitFailure("Unsupported engine '%s'." % (engine))
+        if engine == "gevent" and not monkey.is_module_patched("socket"):
+            monkey.patch_all()
         InputModule.__init__(self, actor_config)
 
         self.pool.createQueue("outbox")
         self.pool.createQueue("ack")
         self.pool.createQueue("cancel")
         self.pool.queue.ack.disableFallThrough()
-        self.connection = None
-        self.connected = False
+
+        self.outputs = ["outbox"]
+        reserved = [name for name in self.pool.listQueues(names=True) if name != "outbox"]
+        for targets in routes.values():
+            for target in [targets] if isinstance(targets, str) else targets:
+                if target in reserved:
+                    raise ModuleInitFailure("Route target '%s' is a reserved queue." % (target))
+                elif target not in self.outputs:
+                    self.outputs.append(target)
+                    self.pool.createQueue(target)
+        if routes:
+            self.router = TopicMatcher(routes, default=("outbox",))
+        else:
+            self.router = None
+
+        if native_events:
+            if not self.actorconfig_defined_decoder:
+                if msgpack is None:
+                    raise ModuleInitFailure("Consuming native events requires the msgpack package.")
+                self.getDecoder = lambda: MsgpackDecoder().handler
+            self.generateEvent = buildEvent
+        self.batching = event_batch_size > 1 and not native_events
+        if compression is not None and compression not in CODECS:
+            raise ModuleInitFailure("Unsupported compression '%s'." % (compression))
+
+        self.bindings = self.getBindings()
+        if stream_offset is not None:
+            for binding in self.bindings:
+                if binding.queue_declare and (not binding.queue_durable or binding.queue_auto_delete or binding.queue_exclusive):
+                    raise ModuleInitFailure("Stream queue '%s' has to be durable, not auto deleted and not exclusive." % (binding.queue))
+        self.hosts = self.getHosts()
+        self.host_cursor = -1
+        self.declared = set()
+        self.ack_latency = 0
+        self.metrics = Metrics()
+        self.backlog = deque()
+        if body_delimiter is None:
+            self.body_delimiter = None
+        else:
+            self.body_delimiter = body_delimiter.encode("utf-8")
+        self.paused = False
+        self.capture = None
+        self.tmp = None
+        self.metadata = []
+        for source, key in metadata.items():
+            if source not in METADATA_SOURCES and source != "headers" and not source.startswith("headers."):
+                raise ModuleInitFailure("Unsupported metadata source '%s'." % (source))
+            if key in ("channel", "delivery_tag", "delivery_tags", "generation", "queue"):
+                raise ModuleInitFailure("Metadata key '%s' is reserved." % (key))
+        self.offsets = {}
+        if stream_offset is not None and no_ack:
+            raise ModuleInitFailure("Consuming a stream requires acknowledgements.")
+        if prefetch_bytes > 0 and no_ack:
+            raise ModuleInitFailure("Limiting the bytes in flight requires acknowledgements.")
+        if dedup_key is None:
+            self.dedup = None
+        elif dedup_key in ("message_id", "body") or dedup_key.startswith("headers."):
+            self.dedup = DeduplicationCache(dedup_size, dedup_ttl)
+        else:
+            raise ModuleInitFailure("Unsupported dedup_key '%s'." % (dedup_key))
+        self.links = [Link(index) for index in range(max(1, min(connections, consumers * len(self.bindings))))]
+        self.consumers = []
+        for binding in self.bindings:
+            for _ in range(consumers):
+                index = len(self.consumers)
+                self.consumers.append(Consumer(index, self.links[index % len(self.links)], binding))
+                if prefetch_adaptive:
+                    self.consumers[index].prefetch = max(prefetch_min, min(binding.prefetch_count, prefetch_max))
+
+    def getBindings(self):
+        '''
+        Returns the list of ``Binding`` instances to consume, completing
+        each one with the module parameters it does not define.
+        '''
+
+        bindings = []
+        for definition in self.kwargs.bindings or [{}]:
+            values = {}
+            for name in Binding.PARAMETERS:
+                values[name] = definition.get(name, self.kwargs[name])
+            if "routing_keys" in definition:
+                values["routing_keys"] = list(definition["routing_keys"])
+            else:
+                values["routing_keys"] = [definition.get("routing_key", self.kwargs.routing_key)]
+            bindings.append(Binding(**values))
+        return bindings
 
     def preHook(self):
-        self._queue_arguments = dict(self.kwargs.queue_arguments)
-        self._exchange_arguments = dict(self.kwargs.exchange_arguments)
-        self.sendToBackground(self.drain)
+        if self.kwargs.engine == "none" and not monkey.is_module_patched("socket"):
+            self.logging.warning("The socket module is not patched.  Reading from the broker blocks all other greenlets.")
+        for consumer in self.consumers:
+            consumer.decode = self.getDecoder()
+        self.tmp = "tmp.%s" % (self.name)
+        self.metadata = self.getMetadata()
+        if self.kwargs.stream_offset is not None:
+            self.offsets = self.loadOffsets()
+            self.sendToBackground(self.checkpointOffsets)
+        if self.kwargs.capture is not None:
+            self.capture = CaptureWriter(self.kwargs.capture)
+            self.logging.info("Capturing deliveries to %s." % (self.kwargs.capture))
+        if self.kwargs.replay is not None:
+            for consumer in self.consumers:
+                consumer.channel = ReplayChannel()
+                consumer.tracker = DeliveryTracker(consumer.channel, consumer.generation)
+            self.sendToBackground(self.replayCapture)
+        else:
+            for link in self.links:
+                self.sendToBackground(self.drain, link)
+                if self.kwargs.heartbeat > 0:
+                    self.sendToBackground(self.sendHeartbeats, link)
         self.sendToBackground(self.handleAcknowledgements)
         self.sendToBackground(self.handleAcknowledgementsCancel)
+        if self.kwargs.ack_batch_size > 1:
+            self.sendToBackground(self.flushAcknowledgements)
+        if self.kwargs.ack_timeout > 0:
+            self.sendToBackground(self.expireDeliveries)
+        if self.batching:
+            self.sendToBackground(self.flushBatches)
+        if self.kwargs.prefetch_adaptive:
+            self.sendToBackground(self.adjustPrefetch)
+        if self.kwargs.outbox_high_watermark > 0 or self.kwargs.prefetch_bytes > 0:
+            self.sendToBackground(self.regulateFlow)
+        self.sendToBackground(self.produceMetrics)
         if self.kwargs.heartbeat > 0:
-            self.logging.info("Sending heartbeat every %s seconds." % (self.kwargs.heartbeat))
-            self.sendToBackground(self.heartbeat)
-
-    def consume(self, message):
-        for chunk in [message.body, None]:
-            for item in self.decode(chunk):
-                event = self.generateEvent(
-                    item,
-                    self.kwargs.destination
-                )
-                event.set({}, "tmp.%s" % (self.name))
-                event.set(message.delivery_info["delivery_tag"], "tmp.%s.delivery_tag" % (self.name))
-                self.submit(event, "outbox")
+            self.logging.info("Exchanging heartbeats every %s seconds." % (self.kwargs.heartbeat))
+
+    def consume(self, consumer, message):
+        tag = message.delivery_info["delivery_tag"]
+        if not self.kwargs.no_ack:
+            consumer.tracker.deliver(tag, message.body_size)
+            if self.kwargs.prefetch_bytes > 0 and not self.paused and self.getInFlightBytes() >= self.kwargs.prefetch_bytes:
+                self.pause("In flight bytes reached %s." % (self.kwargs.prefetch_bytes))
+        self.metrics.deliveries += 1
+        self.metrics.bytes += message.body_size
+        if message.delivery_info.get("redelivered"):
+            self.metrics.redeliveries += 1
+        if self.capture is not None:
+            self.capture.write(consumer.binding.queue, message, time())
+        if self.dedup is not None and self.isDuplicate(consumer, tag, message):
+            self.metrics.dedup_hits += 1
+            if not self.kwargs.no_ack and consumer.tracker.ack(tag):
+                if consumer.tracker.settled >= self.kwargs.ack_batch_size:
+                    self.settle(consumer.tracker)
+            return
+        body = message.body
+        codec = message.properties.get("content_encoding")
+        if codec not in CODECS:
+            codec = self.kwargs.compression
+        if codec is not None and not isinstance(body, str):
+            try:
+                body = self.decompress(codec, body)
+            except DecompressionError as err:
+                self.logging.error("Rejected message %s of queue %s.  Reason: %s" % (tag, consumer.binding.queue, err))
+                self.metrics.rejected += 1
+                consumer.dedup_keys.pop(tag, None)
+                if not self.kwargs.no_ack and consumer.tracker.reject(tag):
+                    self.settle(consumer.tracker)
+                return
+        if self.kwargs.retry_attempts > 0 and not self.kwargs.no_ack:
+            consumer.messages[tag] = message
+        if self.kwargs.stream_offset is not None:
+            offset = (message.properties.get("application_headers") or {}).get("x-stream-offset")
+            if offset is not None:
+                consumer.offsets[tag] = offset
+                consumer.next_offset = offset + 1
+        if self.router is None:
+            queues = ("outbox",)
+        else:
+            queues = self.router.match(self.getOrigin(message, "routing_key"))
+        if self.metadata:
+            metadata = self.extractMetadata(message)
+        else:
+            metadata = {}
+        if not self.kwargs.no_ack:
+            consumer.tracker.hold(tag)
+        decode_time = 0
+        for record in self.iterRecords(body):
+            start = time()
+            items = list(consumer.decode(record))
+            items.extend(consumer.decode(None))
+            decode_time += time() - start
+            for item in items:
+                if self.batching:
+                    consumer.batch.append(item)
+                    if not consumer.batch_tags or consumer.batch_tags[-1] != tag:
+                        consumer.batch_tags.append(tag)
+                        if not self.kwargs.no_ack:
+                            consumer.tracker.hold(tag)
+                    if len(consumer.batch) >= self.kwargs.event_batch_size:
+                        self.flushBatch(consumer)
+                else:
+                    event = self.generateEvent(
+                        item,
+                        self.kwargs.destination
+                    )
+                    event.set(dict(
+                        metadata,
+                        delivery_tag=tag,
+                        channel=consumer.index,
+                        generation=consumer.generation,
+                        queue=consumer.binding.queue
+                    ), self.tmp)
+                    if not self.kwargs.no_ack:
+                        consumer.tracker.hold(tag, len(queues))
+                    for queue in queues[1:]:
+                        self.forward(event.clone(), queue)
+                    self.forward(event, queues[0])
+        self.metrics.decode_time.add(decode_time)
+        if not self.kwargs.no_ack:
+            self.release(consumer, consumer.tracker, tag)
+            if consumer.tracker.settled >= self.kwargs.ack_batch_size:
+                self.settle(consumer.tracker)
+
+    def flushBatch(self, consumer):
+        '''
+        Submits the items collected by ``consumer`` as a single event.
+        '''
+
+        items, tags = consumer.batch, consumer.batch_tags
+        consumer.batch, consumer.batch_tags = [], []
+        event = self.generateEvent(
+            items,
+            self.kwargs.destination
+        )
+        event.set({
+            "delivery_tag": tags[-1],
+            "delivery_tags": tags,
+            "channel": consumer.index,
+            "generation": consumer.generation,
+            "queue": consumer.binding.queue
+        }, self.tmp)
+        self.forward(event, "outbox")
+
+    def flushBatches(self):
+
+        while self.loop():
+            sleep(self.kwargs.event_batch_interval)
+            for consumer in self.consumers:
+                if consumer.batch:
+                    self.flushBatch(consumer)
+
+    def getMetadata(self):
+        '''
+        Returns the (location, name, key) tuples resolving <metadata> where
+        location is one of "delivery_info", "origin", "properties",
+        "headers" or "header".
+        '''
+
+        metadata = []
+        for source, key in sorted(self.kwargs.metadata.items()):
+            if source == "headers":
+                metadata.append(("headers", None, key))
+            elif source.startswith("headers."):
+                metadata.append(("header", source.split(".", 1)[1], key))
+            else:
+                metadata.append((METADATA_SOURCES[source], source, key))
+        return metadata
+
+    def extractMetadata(self, message):
+        '''
+        Returns the <metadata> ``message`` carries keyed by the keys to
+        store them in.
+        '''
+
+        headers = message.properties.get("application_headers") or {}
+        metadata = {}
+        for location, name, key in self.metadata:
+            if location == "delivery_info":
+                value = message.delivery_info.get(name)
+            elif location == "origin":
+                value = self.getOrigin(message, name)
+            elif location == "properties":
+                value = message.properties.get(name)
+            elif location == "headers":
+                value = headers or None
+            else:
+                value = headers.get(name)
+            if value is not None:
+                metadata[key] = value
+        return metadata
+
+    def getOrigin(self, message, name):
+        '''
+        Returns the exchange or routing key ``message`` was originally
+        published with.  Retried messages keep them in a header because
+        they are dead-lettered back from their delay queue with the queue
+        name as routing key.
+        '''
+
+        headers = message.properties.get("application_headers")
+        if headers and ORIGIN_HEADERS[name] in headers:
+            return headers[ORIGIN_HEADERS[name]]
+        else:
+            return message.delivery_info.get(name, "")
+
+    def isDuplicate(self, consumer, tag, message):
+        '''
+        Returns True when ``message`` is a redelivery of a message received
+        before.  Otherwise remembers its key.
+        '''
+
+        if self.kwargs.dedup_key == "message_id":
+            key = message.properties.get("message_id")
+        elif self.kwargs.dedup_key == "body":
+            body = message.body
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            key = hashlib.blake2b(body, digest_size=16).digest()
+        else:
+            key = message.properties.get("application_headers", {}).get(self.kwargs.dedup_key.split(".", 1)[1])
+
+        if key is None:
+            return False
+        if message.delivery_info.get("redelivered"):
+            if self.dedup.seen(key):
+                return True
+            self.metrics.dedup_misses += 1
+        self.dedup.add(key)
+        if not self.kwargs.no_ack:
+            consumer.dedup_keys[tag] = key
+        return False
+
+    def decompress(self, codec, body):
+        '''
+        Decompresses ``body`` with ``codec``.  Bodies larger than
+        <decompress_threshold> are decompressed in the thread pool of the
+        hub.
+        '''
+
+        if len(body) > self.kwargs.decompress_threshold:
+            result = get_hub().threadpool.apply(self.decompressSafely, (codec, body))
+            if isinstance(result, DecompressionError):
+                raise result
+            return result
+        else:
+            return decompress(codec, body, self.kwargs.decompress_max_size)
+
+    def decompressSafely(self, codec, body):
+        '''
+        Returns the decompressed ``body`` or the DecompressionError raised
+        so errors in the thread pool are not reported as crashes of the
+        thread.
+        '''
+
+        try:
+            return decompress(codec, body, self.kwargs.decompress_max_size)
+        except DecompressionError as err:
+            return err
 
-    def setupConnectivity(self):
+    def iterRecords(self, body):
+        '''
+        Yields the records of ``body`` delimited by <body_delimiter>.
 
+        The body is sliced through a memoryview so only the record being
+        decoded is copied.  A body without delimiter is yielded as is.
+        '''
+
+        if self.body_delimiter is None:
+            yield body
+            return
+
+        if isinstance(body, str):
+            delimiter = self.body_delimiter.decode("utf-8")
+            view, copy = body, str
+        else:
+            delimiter = self.body_delimiter
+            view, copy = memoryview(body), bytes
+
+        start = 0
+        end = body.find(delimiter)
+        if end == -1:
+            yield body
+            return
+
+        while end != -1:
+            if end > start:
+                yield copy(view[start:end])
+            start = end + len(delimiter)
+            end = body.find(delimiter, start)
+
+        if start < len(body):
+            yield copy(view[start:])
+
+    def forward(self, event, queue):
+        '''
+        Submits ``event`` to ``queue`` without blocking the calling drain
+        loop.  When flow control is enabled and the queue is full, or events
+        are already held back, ``event`` is appended to the backlog which is
+        submitted by ``regulateFlow``.
+        '''
+
+        if self.kwargs.outbox_high_watermark <= 0:
+            start = time()
+            self.submit(event, queue)
+            self.metrics.submit_blocked += time() - start
+        else:
+            target = getattr(self.pool.queue, queue)
+            if self.backlog or target.size() >= target.max_size:
+                self.backlog.append((event, queue))
+            else:
+                self.submit(event, queue)
+            if not self.paused and target.size() >= target.max_size * self.kwargs.outbox_high_watermark:
+                self.pause("Outbox reached its high watermark.")
+
+    def getInFlightBytes(self):
+        '''
+        Returns the number of body bytes of all messages in flight.
+        '''
+
+        return sum([consumer.tracker.bytes for consumer in self.consumers if consumer.tracker is not None])
+
+    def getFill(self):
+        '''
+        Returns the fill ratio of the fullest queue events are submitted to.
+        '''
+
+        fill = 0.0
+        for name in self.outputs:
+            queue = getattr(self.pool.queue, name)
+            fill = max(fill, float(queue.size()) / queue.max_size)
+        return fill
+
+    def replayCapture(self):
+        '''
+        Feeds the deliveries stored in <replay> through ``consume`` at
+        <replay_speed> times the original pace.  Each delivery is handed to
+        the first consumer of the queue it was captured from.
+        '''
+
+        consumers = {}
+        for consumer in reversed(self.consumers):
+            consumers[consumer.binding.queue] = consumer
+        tags = {}
+        first = None
+        start = time()
+        count = 0
+        self.logging.info("Replaying deliveries from %s." % (self.kwargs.replay))
+        for timestamp, queue, message in CaptureReader(self.kwargs.replay):
+            if self.kwargs.replay_speed > 0:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / self.kwargs.replay_speed - (time() - start)
+                if delay > 0:
+                    sleep(delay)
+            else:
+                sleep(0)
+            while self.paused and self.loop():
+                sleep(0.1)
+            if not self.loop():
+                break
+            consumer = consumers.get(queue, self.consumers[0])
+            tags[consumer.index] = tags.get(consumer.index, 0) + 1
+            message.delivery_info["delivery_tag"] = tags[consumer.index]
+            self.consume(consumer, message)
+            count += 1
+        self.logging.info("Replayed %s deliveries from %s." % (count, self.kwargs.replay))
+
+    def setupConnectivity(self, link):
+
+        attempt = 0
         while self.loop():
+            for host in self.selectHosts():
+                self.disconnect(link)
+                try:
+                    self.connect(link, host)
+                except Exception as err:
+                    self.declared.clear()
+                    self.logging.error("Failed to connect to broker %s.  Reason %s " % (host, err))
+                else:
+                    link.connected = True
+                    return
+            sleep(self.getBackoff(attempt))
+            attempt += 1
+
+    def connect(self, link, host):
+        '''
+        Connects ``link`` to ``host``, opens the channels of its consumers,
+        declares the topology and starts consuming.
+        '''
+
+        link.connection = amqp_connection(
+            heartbeat=self.kwargs.heartbeat,
+            host=host,
+            virtual_host=self.kwargs.vhost,
+            userid=self.kwargs.user,
+            password=self.kwargs.password,
+            ssl=self.kwargs.ssl
+        )
+        link.connection.connect()
+        for consumer in link.consumers:
+            if self.dedup is not None:
+                # Batched items are dropped so their redelivery has to pass.
+                for tag in consumer.batch_tags:
+                    if tag in consumer.dedup_keys:
+                        self.dedup.discard(consumer.dedup_keys[tag])
+            consumer.channel = link.connection.channel()
+            consumer.generation += 1
+            consumer.tracker = DeliveryTracker(consumer.channel, consumer.generation)
+            consumer.batch, consumer.batch_tags = [], []
+            consumer.confirms = {}
+            consumer.dedup_keys = {}
+            consumer.messages = {}
+            consumer.next_offset = None
+            consumer.offsets = {}
+            consumer.published = 0
+            consumer.returned = set()
+            if self.kwargs.retry_attempts > 0 and not self.kwargs.no_ack:
+                consumer.channel.confirm_select()
+                consumer.channel.events["basic_ack"].add(partial(self.confirmRetry, consumer, consumer.tracker, True))
+                consumer.channel.events["basic_nack"].add(partial(self.confirmRetry, consumer, consumer.tracker, False))
+                consumer.channel.events["basic_return"].add(partial(self.returnRetry, consumer))
+
+        channel = link.consumers[0].channel
+        for binding in self.bindings:
+            if binding in [consumer.binding for consumer in link.consumers]:
+                self.declare(channel, binding)
+
+        for consumer in link.consumers:
+            if self.kwargs.prefetch_adaptive:
+                consumer.channel.basic_qos(prefetch_size=0, prefetch_count=self.kwargs.prefetch_max, a_global=False)
+                consumer.channel.basic_qos(prefetch_size=0, prefetch_count=consumer.prefetch, a_global=True)
+            else:
+                consumer.channel.basic_qos(prefetch_size=0, prefetch_count=consumer.binding.prefetch_count, a_global=False)
+            if not self.paused:
+                self.startConsuming(consumer)
+        self.logging.info("Connected to broker %s with %s consumer(s) on connection %s." % (host, len(link.consumers), link.index))
+
+    def disconnect(self, link):
+        '''
+        Releases the resources of the current connection of ``link``.
+        '''
+
+        if link.connection is not None:
             try:
-                self.connection = amqp_connection(
-                    heartbeat=self.kwargs.heartbeat,
-                    host=self.kwargs.host,
-                    port=self.kwargs.port,
-                    virtual_host=self.kwargs.vhost,
-                    userid=self.kwargs.user,
-                    password=self.kwargs.password,
-                    ssl=self.kwargs.ssl
+                link.connection.collect()
+            except Exception as err:
+                del(err)
+            link.connection = None
+
+    def declare(self, channel, binding):
+        '''
+        Declares the exchange and queue of ``binding`` and binds them.
+
+        Durable exchanges and queues which are neither auto deleted nor
+        exclusive outlive the connection.  Once declared they are remembered
+        so reconnects skip declaring them again.
+        '''
+
+        exchange_persistent = binding.exchange_durable and not binding.exchange_auto_delete
+        queue_persistent = binding.queue_durable and not binding.queue_auto_delete and not binding.queue_exclusive
+
+        if binding.exchange != "" and ("exchange", binding.exchange) not in self.declared:
+            channel.exchange_declare(
+                binding.exchange,
+                binding.exchange_type,
+                durable=binding.exchange_durable,
+                auto_delete=binding.exchange_auto_delete,
+                passive=binding.exchange_passive,
+                arguments=dict(binding.exchange_arguments)
+            )
+            if exchange_persistent:
+                self.declared.add(("exchange", binding.exchange))
+            self.logging.debug("Declared exchange %s." % (binding.exchange))
+
+        if binding.queue_declare and ("queue", binding.queue) not in self.declared:
+            arguments = dict(binding.queue_arguments)
+            if self.kwargs.stream_offset is not None:
+                arguments.setdefault("x-queue-type", "stream")
+            channel.queue_declare(
+                binding.queue,
+                durable=binding.queue_durable,
+                exclusive=binding.queue_exclusive,
+                auto_delete=binding.queue_auto_delete,
+                arguments=arguments
+            )
+            if queue_persistent:
+                self.declared.add(("queue", binding.queue))
+            self.logging.debug("Declared queue %s." % (binding.queue))
+
+        for attempt in range(self.kwargs.retry_attempts):
+            retry_queue = self.getRetryQueue(binding, attempt)
+            if ("queue", retry_queue) not in self.declared:
+                channel.queue_declare(
+                    retry_queue,
+                    durable=binding.queue_durable,
+                    auto_delete=False,
+                    arguments={
+                        "x-message-ttl": int(self.getRetryDelay(attempt) * 1000),
+                        "x-dead-letter-exchange": "",
+                        "x-dead-letter-routing-key": binding.queue
+                    }
                 )
-                self.connection.connect()
-                self.channel = self.connection.channel()
-
-                if self.kwargs.exchange != "":
-                    self.channel.exchange_declare(
-                        self.kwargs.exchange,
-                        self.kwargs.exchange_type,
-                        durable=self.kwargs.exchange_durable,
-                        auto_delete=self.kwargs.exchange_auto_delete,
-                        passive=self.kwargs.exchange_passive,
-                        arguments=self._exchange_arguments
-                    )
-                    self.logging.debug("Declared exchange %s." % (self.kwargs.exchange))
-
-                if self.kwargs.queue_declare:
-                    self.channel.queue_declare(
-                        self.kwargs.queue,
-                        durable=self.kwargs.queue_durable,
-                        exclusive=self.kwargs.queue_exclusive,
-                        auto_delete=self.kwargs.queue_auto_delete,
-                        arguments=self._queue_arguments
-                    )
-                    self.logging.debug("Declared queue %s." % (self.kwargs.queue))
+                if binding.queue_durable:
+                    self.declared.add(("queue", retry_queue))
+                self.logging.debug("Declared retry queue %s." % (retry_queue))
 
-                if self.kwargs.exchange != "":
-                    self.channel.queue_bind(
-                        self.kwargs.queue,
-                        self.kwargs.exchange,
-                        routing_key=self.kwargs.routing_key
+        if binding.exchange != "":
+            for routing_key in binding.routing_keys:
+                if ("binding", binding.queue, binding.exchange, routing_key) not in self.declared:
+                    channel.queue_bind(
+                        binding.queue,
+                        binding.exchange,
+                        routing_key=routing_key
                     )
-                    self.logging.debug("Bound queue %s to exchange %s." % (self.kwargs.queue, self.kwargs.exchange))
+                    if exchange_persistent and queue_persistent:
+                        self.declared.add(("binding", binding.queue, binding.exchange, routing_key))
+                    self.logging.debug("Bound queue %s to exchange %s with routing key '%s'." % (binding.queue, binding.exchange, routing_key))
 
-                self.channel.basic_qos(prefetch_size=0, prefetch_count=self.kwargs.prefetch_count, a_global=False)
-                self.channel.basic_consume(self.kwargs.queue, callback=self.consume, no_ack=self.kwargs.no_ack)
-                self.logging.info("Connected to broker.")
-            except Exception as err:
-                self.logging.error("Failed to connect to broker.  Reason %s " % (err))
-                sleep(1)
+    def getRetryDelay(self, attempt):
+        '''
+        Returns the number of seconds to delay retry ``attempt``.
+        '''
+
+        return min(self.kwargs.retry_delay * 2 ** attempt, self.kwargs.retry_delay_max)
+
+    def getRetryQueue(self, binding, attempt):
+        '''
+        Returns the name of the delay queue of retry ``attempt`` of the
+        messages of ``binding``.
+        '''
+
+        return "%s.retry.%s" % (binding.queue, int(self.getRetryDelay(attempt) * 1000))
+
+    def retry(self, consumer, tracker, tag):
+        '''
+        Republishes the message delivered with ``tag`` to its delay queue
+        or rejects it without requeueing once it ran out of attempts.
+
+        The message is only acknowledged once the broker confirmed the
+        republished copy, see ``confirmRetry``.
+        '''
+
+        message = consumer.messages.pop(tag, None)
+        if message is None:
+            return
+        headers = dict(message.properties.get("application_headers") or {})
+        attempt = headers.get("x-retry-attempts", 0)
+        if attempt >= self.kwargs.retry_attempts:
+            if tracker.reject(tag):
+                self.metrics.dead_lettered += 1
+            return
+
+        consumer.published += 1
+        headers["x-retry-attempts"] = attempt + 1
+        headers["x-retry-sequence"] = consumer.published
+        for name, header in ORIGIN_HEADERS.items():
+            headers.setdefault(header, message.delivery_info.get(name, ""))
+        properties = dict(message.properties)
+        properties["application_headers"] = headers
+        try:
+            consumer.channel.basic_publish(
+                Message(message.body, **properties),
+                exchange="",
+                routing_key=self.getRetryQueue(consumer.binding, attempt),
+                mandatory=True
+            )
+        except Exception as err:
+            self.logging.error("Failed to retry message.  Requeueing it instead.  Reason: %s" % (err))
+            if tracker.nack(tag):
+                self.metrics.cancelled += 1
+        else:
+            consumer.confirms[consumer.published] = tag
+
+    def confirmRetry(self, consumer, tracker, confirmed, sequence, multiple):
+        '''
+        Acknowledges the messages whose republished copy up to publish
+        ``sequence`` was confirmed by the broker.  The messages are
+        requeued instead when the broker refused or returned the copy.
+        '''
+
+        if tracker is not consumer.tracker:
+            return
+        if multiple:
+            sequences = sorted([number for number in consumer.confirms if number <= sequence])
+        else:
+            sequences = [sequence]
+        for number in sequences:
+            tag = consumer.confirms.pop(number, None)
+            if tag is None:
+                continue
+            if confirmed and number not in consumer.returned:
+                if tracker.ack(tag):
+                    self.metrics.retried += 1
             else:
-                self.connected = True
-                break
+                consumer.returned.discard(number)
+                self.logging.error("Failed to retry message %s of queue %s.  Requeueing it instead.  Reason: the broker did not accept the republished message." % (tag, consumer.binding.queue))
+                if tracker.nack(tag):
+                    self.metrics.cancelled += 1
+        if tracker.settled >= self.kwargs.ack_batch_size:
+            self.settle(tracker)
+
+    def returnRetry(self, consumer, exc, exchange, routing_key, message):
+        '''
+        Records the republished copy ``message`` returned by the broker as
+        unroutable so its confirm does not acknowledge the original.
+        '''
+
+        self.logging.warning("Delay queue %s returned a retried message.  Reason: %s" % (routing_key, exc))
+        sequence = (message.properties.get("application_headers") or {}).get("x-retry-sequence")
+        if sequence in consumer.confirms:
+            consumer.returned.add(sequence)
 
-    def drain(self):
+    def drain(self, link):
+        '''
+        Reads the frames of ``link`` and executes its scheduled actions.
 
-        self.setupConnectivity()
+        When heartbeats are enabled, ``heartbeat_tick`` sends heartbeats
+        when nothing else was sent and raises when nothing was received
+        from the broker for two intervals so a dead connection is detected
+        even when the socket does not report an error.  ``sendHeartbeats``
+        keeps sending them while the loop is blocked submitting an event or
+        decompressing a body.
+        '''
+
+        self.setupConnectivity(link)
+        tick_interval = self.kwargs.heartbeat / 4.0
+        next_tick = 0
         while self.loop():
             try:
-                self.connection.drain_events()
+                while link.actions:
+                    link.actions.popleft()()
+                try:
+                    link.connection.drain_events(timeout=0.1)
+                except socket.timeout:
+                    pass
+                if self.kwargs.heartbeat > 0 and time() >= next_tick:
+                    next_tick = time() + tick_interval
+                    link.connection.heartbeat_tick(rate=2)
             except Exception as err:
-                self.connected = False
+                if self.kwargs.heartbeat > 0 and link.connection.last_heartbeat_received:
+                    self.metrics.detection_time.add(monotonic() - link.connection.last_heartbeat_received)
+                link.connected = False
+                link.actions.clear()
+                self.metrics.reconnects += 1
                 self.logging.error("Problem connecting to broker.  Reason: %s" % (err))
-                self.setupConnectivity()
-                sleep(1)
+                self.setupConnectivity(link)
+
+    def sendHeartbeats(self, link):
+        '''
+        Sends a heartbeat on ``link`` when nothing was sent for half the
+        heartbeat interval.
+
+        The drain loop of ``link`` sends heartbeats too but cannot while
+        it is blocked so the broker would drop the connection.  Missed
+        heartbeats of the broker are only detected by the drain loop as it
+        is the one reading them.
+        '''
+
+        while self.loop():
+            sleep(self.kwargs.heartbeat / 4.0)
+            connection = link.connection
+            if not link.connected or connection is None:
+                continue
+            if connection.prev_sent != connection.bytes_sent:
+                connection.prev_sent = connection.bytes_sent
+                connection.last_heartbeat_sent = monotonic()
+            elif monotonic() > connection.last_heartbeat_sent + self.kwargs.heartbeat / 2.0:
+                try:
+                    connection.send_heartbeat()
+                    connection.last_heartbeat_sent = monotonic()
+                except Exception as err:
+                    self.logging.error("Failed to send heartbeat on connection %s.  Reason: %s" % (link.index, err))
+
+    def schedule(self, link, function, *args):
+        '''
+        Executes ``function`` from within the drain loop of ``link``.
+
+        Channel methods waiting for a reply from the broker read frames from
+        the connection and should therefore never run concurrently with
+        the drain loop reading the same connection.
+        '''
+
+        link.actions.append(partial(function, *args))
 
-    def heartbeat(self):
+    def getBackoff(self, attempt):
+        '''
+        Returns the number of seconds to wait after ``attempt`` failed rounds
+        of connecting to all brokers.  The delay doubles each round up to
+        <reconnect_backoff_max> and is jittered to avoid reconnect storms.
+        '''
 
+        delay = min(self.kwargs.reconnect_backoff * 2 ** attempt, self.kwargs.reconnect_backoff_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def getHosts(self):
+        '''
+        Returns the configured brokers as a list of "host:port" strings.
+        '''
+
+        if isinstance(self.kwargs.host, str):
+            hosts = [self.kwargs.host]
+        else:
+            hosts = list(self.kwargs.host)
+
+        result = []
+        for host in hosts:
+            if ":" in host:
+                result.append(host)
+            else:
+                result.append("%s:%s" % (host, self.kwargs.port))
+        return result
+
+    def selectHosts(self):
+        '''
+        Returns the brokers in the order to try them according to
+        <host_selection>.
+        '''
+
+        if self.kwargs.host_selection == "random":
+            hosts = list(self.hosts)
+            random.shuffle(hosts)
+            return hosts
+        elif self.kwargs.host_selection == "prefer-local":
+            local = ["localhost", "::1", socket.gethostname(), socket.getfqdn()]
+            return sorted(self.hosts, key=lambda host: not (host.rsplit(":", 1)[0] in local or host.startswith("127.")))
+        else:
+            self.host_cursor = (self.host_cursor + 1) % len(self.hosts)
+            return self.hosts[self.host_cursor:] + self.hosts[:self.host_cursor]
+
+    def adjustPrefetch(self):
+        '''
+        Grows or shrinks the prefetch window of each consumer within
+        <prefetch_min> and <prefetch_max>.
+
+        The window is halved when the fullest queue events are submitted to
+        is more than half full.  When that queue is nearly empty and a
+        consumer has its complete window in flight, the window doubles as
+        long as it does not exceed twice the consumer's bandwidth-delay
+        product (its acknowledgement rate multiplied by the acknowledgement
+        latency).  A downstream which stops absorbing more messages keeps
+        that product flat and therefore stops the window from growing.
+        '''
+
+        acknowledged = {}
         while self.loop():
-            sleep(self.kwargs.heartbeat)
+            sleep(self.kwargs.prefetch_adaptive_interval)
+            fill = self.getFill()
+            for consumer in self.consumers:
+                if consumer.tracker is None or not consumer.link.connected:
+                    continue
+                tracker, previous = acknowledged.get(consumer.index, (None, 0))
+                if tracker is not consumer.tracker:
+                    previous = 0
+                rate = (consumer.tracker.acknowledged - previous) / float(self.kwargs.prefetch_adaptive_interval)
+                acknowledged[consumer.index] = (consumer.tracker, consumer.tracker.acknowledged)
+                if fill > 0.5:
+                    prefetch = consumer.prefetch // 2
+                elif fill < 0.1 and consumer.tracker.pending >= consumer.prefetch:
+                    prefetch = min(consumer.prefetch * 2, max(int(2 * rate * self.ack_latency), consumer.prefetch + 1))
+                else:
+                    continue
+                prefetch = max(self.kwargs.prefetch_min, min(prefetch, self.kwargs.prefetch_max))
+                if prefetch != consumer.prefetch:
+                    self.schedule(consumer.link, self.setPrefetch, consumer, prefetch)
+
+    def setPrefetch(self, consumer, prefetch):
+
+        consumer.channel.basic_qos(prefetch_size=0, prefetch_count=prefetch, a_global=True)
+        self.logging.debug("Adjusted prefetch count of consumer %s from %s to %s." % (consumer.index, consumer.prefetch, prefetch))
+        consumer.prefetch = prefetch
+
+    def pause(self, reason):
+        '''
+        Cancels all consumers so the broker stops delivering messages.
+        '''
+
+        self.paused = True
+        self.logging.info("%s Pausing consumption." % (reason))
+        for consumer in self.consumers:
+            if consumer.link.connected:
+                try:
+                    consumer.channel.basic_cancel(consumer.tag, nowait=True)
+                except Exception as err:
+                    self.logging.error("Failed to pause consumer %s.  Reason: %s" % (consumer.index, err))
+
+    def resume(self):
+        '''
+        Restarts all consumers cancelled by ``pause``.
+        '''
+
+        self.paused = False
+        self.logging.info("Outbox and in flight bytes drained to their low watermark. Resuming consumption.")
+        for consumer in self.consumers:
+            if consumer.link.connected:
+                try:
+                    self.startConsuming(consumer)
+                except Exception as err:
+                    self.logging.error("Failed to resume consumer %s.  Reason: %s" % (consumer.index, err))
+
+    def regulateFlow(self):
+        '''
+        Submits the backlog held back by ``forward`` and resumes consumption
+        once the outbox, routed queues and in flight bytes drained to their
+        low watermark.
+        '''
+
+        while self.loop():
+            while self.backlog:
+                start = time()
+                self.submit(*self.backlog[0])
+                self.metrics.submit_blocked += time() - start
+                self.backlog.popleft()
+            if self.paused and self.isDrained():
+                self.resume()
+            sleep(0.1)
+
+    def isDrained(self):
+        '''
+        Returns True when the outbox, routed queues and in flight bytes are
+        at or below their low watermark.
+        '''
+
+        if self.kwargs.outbox_high_watermark > 0 and self.getFill() > self.kwargs.outbox_low_watermark:
+            return False
+        if self.kwargs.prefetch_bytes > 0 and self.getInFlightBytes() > self.kwargs.prefetch_bytes * self.kwargs.outbox_low_watermark:
+            return False
+        return True
+
+    def startConsuming(self, consumer):
+
+        if self.kwargs.stream_offset is None:
+            arguments = None
+        elif consumer.next_offset is not None:
+            arguments = {"x-stream-offset": consumer.next_offset}
+        else:
+            arguments = {"x-stream-offset": self.getStreamOffset(consumer.binding.queue)}
+        consumer.channel.basic_consume(
+            consumer.binding.queue,
+            consumer_tag=consumer.tag,
+            callback=partial(self.consume, consumer),
+            no_ack=self.kwargs.no_ack,
+            nowait=True,
+            arguments=arguments
+        )
+
+    def getStreamOffset(self, queue):
+        '''
+        Returns the x-stream-offset to consume stream ``queue`` from.
+        '''
+
+        if queue in self.offsets:
+            return self.offsets[queue]
+        offset = self.kwargs.stream_offset
+        if isinstance(offset, str):
+            if offset.isdigit():
+                return int(offset)
+            elif offset.startswith("timestamp:"):
+                return datetime.fromtimestamp(float(offset.split(":", 1)[1]), timezone.utc)
+        return offset
+
+    def loadOffsets(self):
+        '''
+        Returns the stream offsets saved in <stream_checkpoint>.
+        '''
+
+        if self.kwargs.stream_checkpoint is None or not os.path.exists(self.kwargs.stream_checkpoint):
+            return {}
+        try:
+            with open(self.kwargs.stream_checkpoint) as f:
+                offsets = json.load(f)
+        except Exception as err:
+            self.logging.error("Failed to load stream offsets from %s.  Reason: %s" % (self.kwargs.stream_checkpoint, err))
+            return {}
+        else:
+            self.logging.info("Resuming streams from offsets %s." % (offsets))
+            return offsets
+
+    def saveOffsets(self):
+        '''
+        Collects the offsets following the acknowledged messages of each
+        stream and saves them to <stream_checkpoint>.
+
+        Only messages delivered before the lowest unacknowledged message
+        count so no message is skipped when resuming.
+        '''
+
+        offsets = dict(self.offsets)
+        for consumer in self.consumers:
+            if consumer.tracker is None or not consumer.offsets:
+                continue
+            lowest = consumer.tracker.lowestPending()
+            done = [tag for tag in consumer.offsets if tag < lowest]
+            if done:
+                offset = max([consumer.offsets.pop(tag) for tag in done]) + 1
+                offsets[consumer.binding.queue] = max(offset, offsets.get(consumer.binding.queue, 0))
+        if offsets == self.offsets:
+            return
+        self.offsets = offsets
+        if self.kwargs.stream_checkpoint is not None:
             try:
-                if self.connected:
-                    self.connection.send_heartbeat()
+                with open(self.kwargs.stream_checkpoint + ".tmp", "w") as f:
+                    json.dump(offsets, f)
+                os.replace(self.kwargs.stream_checkpoint + ".tmp", self.kwargs.stream_checkpoint)
             except Exception as err:
-                self.logging.error("Failed to send heartbeat. Reason: %s" % (err))
+                self.logging.error("Failed to save stream offsets to %s.  Reason: %s" % (self.kwargs.stream_checkpoint, err))
+
+    def checkpointOffsets(self):
+
+        while self.loop():
+            sleep(self.kwargs.stream_checkpoint_interval)
+            self.saveOffsets()
+
+    def flushAcknowledgements(self):
+
+        while self.loop():
+            sleep(self.kwargs.ack_batch_interval)
+            for consumer in self.consumers:
+                if consumer.tracker is not None and consumer.tracker.settled > 0:
+                    self.settle(consumer.tracker)
+
+    def expireDeliveries(self):
+        '''
+        Rejects and requeues the messages which remained unacknowledged for
+        more than <ack_timeout> seconds.
+        '''
+
+        while self.loop():
+            sleep(min(self.kwargs.ack_timeout, 1))
+            before = time() - self.kwargs.ack_timeout
+            for consumer in self.consumers:
+                if consumer.tracker is not None and consumer.link.connected:
+                    expired = consumer.tracker.expire(before)
+                    if expired:
+                        self.metrics.expired += expired
+                        self.logging.warning("Requeued %s message(s) of consumer %s not acknowledged within %s seconds." % (expired, consumer.index, self.kwargs.ack_timeout))
+                        self.settle(consumer.tracker)
+                        for tag in [tag for tag in consumer.dedup_keys if tag < consumer.tracker.base]:
+                            self.dedup.discard(consumer.dedup_keys.pop(tag))
+                        for tag in [tag for tag in consumer.messages if tag < consumer.tracker.base]:
+                            del consumer.messages[tag]
+
+    def getConsumer(self, event):
+        '''
+        Returns the consumer which received ``event``.
+        '''
+
+        if event.has("tmp.%s.channel" % (self.name)):
+            return self.consumers[event.get("tmp.%s.channel" % (self.name))]
+        else:
+            return self.consumers[0]
+
+    def getTracker(self, event):
+        '''
+        Returns the tracker of the channel owning the delivery tag of ``event``
+        or None when that channel has been closed.
+        '''
+
+        tracker = self.getConsumer(event).tracker
+        generation = "tmp.%s.generation" % (self.name)
+        if tracker is not None and (not event.has(generation) or event.get(generation) == tracker.generation):
+            return tracker
+
+    def getDeliveryTags(self, event):
+        '''
+        Returns the list of delivery tags ``event`` refers to.
+        '''
+
+        if event.has("tmp.%s.delivery_tags" % (self.name)):
+            return event.get("tmp.%s.delivery_tags" % (self.name))
+        else:
+            return [event.get("tmp.%s.delivery_tag" % (self.name))]
 
     def handleAcknowledgements(self):
         while self.loop():
-            event = self.pool.queue.ack.get()
-            if event.has("tmp.%s.delivery_tag" % (self.name)):
-                try:
-                    self.channel.basic_ack(event.get("tmp.%s.delivery_tag" % (self.name)))
-                except Exception as err:
-                    self.pool.queue.ack.rescue(event)
-                    self.logging.error("Failed to acknowledge message.  Reason: %s." % (err))
-                    sleep(1)
-            else:
-                self.logging.debug("Cannot acknowledge message because 'tmp.%s.delivery_tag' is missing." % (self.name))
+            self.acknowledge(self.pool.queue.ack.get())
 
     def handleAcknowledgementsCancel(self):
         while self.loop():
-            event = self.pool.queue.cancel.get()
+            self.cancel(self.pool.queue.cancel.get())
+
+    def acknowledge(self, event):
+        '''
+        Acknowledges the messages ``event`` refers to.
+        '''
+
+        if event.has("tmp.%s.delivery_tag" % (self.name)):
+            tracker = self.getTracker(event)
+            if tracker is None:
+                self.metrics.stale += len(self.getDeliveryTags(event))
+                self.logging.debug("Dropped acknowledgement of a message delivered on a closed channel.")
+                return
+            consumer = self.getConsumer(event)
+            for tag in self.getDeliveryTags(event):
+                self.release(consumer, tracker, tag)
+            if tracker.settled >= self.kwargs.ack_batch_size:
+                self.settle(tracker)
+        else:
+            self.logging.debug("Cannot acknowledge message because 'tmp.%s.delivery_tag' is missing." % (self.name))
+
+    def cancel(self, event):
+        '''
+        Cancels the messages ``event`` refers to.
+        '''
+
+        if event.has("tmp.%s.delivery_tag" % (self.name)):
+            tracker = self.getTracker(event)
+            if tracker is None:
+                self.metrics.stale += len(self.getDeliveryTags(event))
+                self.logging.debug("Dropped cancellation of a message delivered on a closed channel.")
+                return
+            consumer = self.getConsumer(event)
+            for tag in self.getDeliveryTags(event):
+                self.release(consumer, tracker, tag, cancelled=True)
+            if tracker.settled >= self.kwargs.ack_batch_size:
+                self.settle(tracker)
+        else:
+            self.logging.debug("Cannot cancel message because 'tmp.%s.delivery_tag' is missing." % (self.name))
+
+    def release(self, consumer, tracker, tag, cancelled=False):
+        '''
+        Releases one event referring to ``tag`` and settles the message once
+        no other event refers to it anymore.  The message is acknowledged
+        unless any of its events was cancelled.
+        '''
+
+        state = tracker.release(tag, cancelled)
+        if state == ACK:
+            delivered_at = tracker.deliveredAt(tag)
+            consumer.dedup_keys.pop(tag, None)
+            consumer.messages.pop(tag, None)
+            if tracker.ack(tag):
+                latency = time() - delivered_at
+                self.ack_latency += (latency - self.ack_latency) * 0.2
+                self.metrics.ack_latency.add(latency)
+                self.metrics.acknowledged += 1
+        elif state == NACK:
+            if tag in consumer.dedup_keys:
+                self.dedup.discard(consumer.dedup_keys.pop(tag))
+            if self.kwargs.retry_attempts > 0:
+                self.retry(consumer, tracker, tag)
+            elif tracker.nack(tag):
+                self.metrics.cancelled += 1
+
+    def produceMetrics(self):
+        '''
+        Submits the hot path metrics to the _metrics queue every
+        ``actor_config.frequency`` seconds.
+        '''
+
+        hostname = socket.gethostname()
+        while self.loop():
+            sleep(self.config.frequency)
+            metrics = self.metrics.collect()
+            metrics["in_flight"] = sum([consumer.tracker.pending for consumer in self.consumers if consumer.tracker is not None])
+            metrics["in_flight_bytes"] = self.getInFlightBytes()
+            metrics["backlog"] = len(self.backlog)
+            metrics["paused"] = int(self.paused)
+            metrics["redelivery_ratio"] = float(self.metrics.redeliveries) / max(self.metrics.deliveries, 1)
+            for consumer in self.consumers:
+                metrics["consumer.%s.prefetch" % (consumer.index)] = consumer.prefetch
+            for metric, value in metrics.items():
+                event = Wishbone_Event({
+                    "time": time(),
+                    "type": "wishbone",
+                    "source": hostname,
+                    "name": "module.%s.amqp.%s" % (self.name, metric),
+                    "value": value,
+                    "unit": "",
+                    "tags": ()
+                })
+                self.submit(event, "_metrics")
+
+    def settle(self, tracker):
+
+        try:
+            tracker.flush()
+        except Exception as err:
+            self.logging.error("Failed to acknowledge messages.  Reason: %s." % (err))
+
+    def drainInFlight(self):
+        '''
+        Cancels the consumers, processes acknowledgements and cancellations
+        until no message is in flight or <shutdown_timeout> expires and
+        rejects the remaining messages with requeue.  The stream offsets are
+        saved before so the remaining messages are consumed again when
+        resuming.
+
+        The background greenlets are stopped at this point so the ack and
+        cancel queues are consumed directly.
+        '''
+
+        consumers = [consumer for consumer in self.consumers if consumer.link.connected and consumer.tracker is not None]
+        for consumer in consumers:
             try:
-                self.channel.basic_reject(event.get("tmp.%s.delivery_tag" % (self.name)), True)
+                consumer.channel.basic_cancel(consumer.tag, nowait=True)
             except Exception as err:
-                self.pool.queue.ack.rescue(event)
-                self.logging.error("Failed to cancel acknowledge message.  Reason: %s." % (err))
-                sleep(1)
+                self.logging.error("Failed to cancel consumer %s.  Reason: %s" % (consumer.index, err))
+
+        deadline = time() + self.kwargs.shutdown_timeout
+        while time() < deadline and any([consumer.tracker.pending for consumer in consumers]):
+            processed = False
+            for queue, handler in ((self.pool.queue.ack, self.acknowledge), (self.pool.queue.cancel, self.cancel)):
+                try:
+                    handler(queue.get(block=False))
+                    processed = True
+                except QueueEmpty:
+                    pass
+            for link in set([consumer.link for consumer in consumers if consumer.confirms]):
+                # The drain loop is stopped so read the publisher confirms here.
+                try:
+                    link.connection.drain_events(timeout=0)
+                    processed = True
+                except socket.timeout:
+                    pass
+                except Exception as err:
+                    self.logging.error("Failed to read publisher confirms.  Reason: %s" % (err))
+                    for consumer in link.consumers:
+                        consumer.confirms.clear()
+            if not processed:
+                sleep(0.05)
+
+        if self.kwargs.stream_offset is not None:
+            # Expiring settles the remaining tags so they would count as done.
+            self.saveOffsets()
+        for consumer in consumers:
+            requeued = consumer.tracker.expire(float("inf"))
+            if requeued:
+                self.logging.info("Requeueing %s unacknowledged message(s) of consumer %s." % (requeued, consumer.index))
+            self.settle(consumer.tracker)
 
     def postHook(self):
-        try:
-            self.channel.close()
-        except Exception as err:
-            del(err)
+        self.drainInFlight()
+        if self.capture is not None:
+            self.capture.close()
 
-        try:
-            self.connection.close()
-        except Exception as err:
-            del(err)
+        for consumer in self.consumers:
+            try:
+                consumer.channel.close()
+            except Exception as err:
+                del(err)
+
+        for link in self.links:
+            try:
+                link.connection.close()
+            except Exception as err:
+                del(err)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  capture.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from amqp import spec
+from amqp.basic_message import Message
+import mmap
+import os
+import struct
+
+MAGIC = b"WBAMQP01"
+
+# length, time, exchange length, routing key length, queue length, properties length
+RECORD = struct.Struct("<IdHHHI")
+
+
+class CaptureWriter(object):
+
+    '''
+    Appends raw deliveries to a memory-mapped capture file.
+
+    Each record holds the delivery time, exchange, routing key, consuming
+    queue, the AMQP encoded properties (including the headers) and the body.
+    The file grows in steps of ``chunk_size`` bytes and is truncated to its
+    actual length when closed.  Records are appended to an existing capture
+    file.
+
+    Args:
+        path (str): The capture file.
+        chunk_size (int): The number of bytes to grow the file with.
+    '''
+
+    def __init__(self, path, chunk_size=16777216):
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            os.write(self.fd, MAGIC)
+            self.offset = len(MAGIC)
+        else:
+            self.offset = findEnd(self.fd, size)
+        self.map = None
+        self.grow(0)
+
+    def close(self):
+        '''
+        Flushes and unmaps the file and truncates it to the captured records.
+        '''
+
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            os.ftruncate(self.fd, self.offset)
+            os.close(self.fd)
+
+    def grow(self, required):
+
+        size = os.fstat(self.fd).st_size
+        if self.map is not None and self.offset + required <= size:
+            return
+        size = max(size, self.offset + required + self.chunk_size)
+        if self.map is not None:
+            self.map.close()
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def write(self, queue, message, timestamp):
+        '''
+        Appends ``message`` consumed from ``queue`` at ``timestamp``.
+
+        Args:
+            queue (str): The queue the message was consumed from.
+            message (amqp.basic_message.Message): The delivery.
+            timestamp (float): The delivery time.
+        '''
+
+        exchange = message.delivery_info.get("exchange", "").encode("utf-8")
+        routing_key = message.delivery_info.get("routing_key", "").encode("utf-8")
+        queue = queue.encode("utf-8")
+        properties = message._serialize_properties()
+        body = message.body
+        if isinstance(body, str):
+            body = body.encode(message.properties.get("content_encoding") or "utf-8")
+
+        length = RECORD.size - 4 + len(exchange) + len(routing_key) + len(queue) + len(properties) + len(body)
+        self.grow(length + 4)
+        RECORD.pack_into(self.map, self.offset, length, timestamp, len(exchange), len(routing_key), len(queue), len(properties))
+        offset = self.offset + RECORD.size
+        for value in (exchange, routing_key, queue, properties, body):
+            self.map[offset:offset + len(value)] = value
+            offset += len(value)
+        self.offset = offset
+
+
+class CaptureReader(object):
+
+    '''
+    Iterates over the deliveries stored in a capture file.
+
+    Bodies are sliced from the memory-mapped file without reading the file
+    as a whole.
+
+    Args:
+        path (str): The capture file.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+
+    def __iter__(self):
+
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= len(MAGIC):
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                if data[:len(MAGIC)] != MAGIC:
+                    raise ValueError("%s is not a capture file." % (self.path))
+                offset = len(MAGIC)
+                while offset + RECORD.size <= size:
+                    length, timestamp, exchange, routing_key, queue, properties = RECORD.unpack_from(data, offset)
+                    if length == 0 or offset + 4 + length > size:
+                        break
+                    end = offset + 4 + length
+                    offset += RECORD.size
+                    fields = []
+                    for field_length in (exchange, routing_key, queue, properties):
+                        fields.append(data[offset:offset + field_length])
+                        offset += field_length
+                    message = Message(data[offset:end])
+                    message.body_size = end - offset
+                    message._load_properties(spec.Basic.CLASS_ID, fields[3], 0)
+                    self.decodeBody(message)
+                    message.delivery_info = {
+                        "exchange": fields[0].decode("utf-8"),
+                        "routing_key": fields[1].decode("utf-8"),
+                        "redelivered": False
+                    }
+                    yield timestamp, fields[2].decode("utf-8"), message
+                    offset = end
+            finally:
+                data.close()
+
+    def decodeBody(self, message):
+        '''
+        Decodes the body of ``message`` using its content_encoding property
+        the way the channel of py-amqp does for live deliveries.  Bodies
+        which cannot be decoded, for example compressed ones, are kept as
+        bytes.
+        '''
+
+        encoding = message.properties.get("content_encoding")
+        if encoding is not None:
+            try:
+                message.body = message.body.decode(encoding)
+            except Exception:
+                pass
+
+
+def findEnd(fd, size):
+    '''
+    Returns the offset following the last complete record of a capture file.
+    '''
+
+    data = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a capture file.")
+        offset = len(MAGIC)
+        while offset + 4 <= size:
+            length = struct.unpack_from("<I", data, offset)[0]
+            if length == 0 or offset + 4 + length > size:
+                break
+            offset += 4 + length
+        return offset
+    finally:
+        data.close()
+
+
+class ReplayChannel(object):
+
+    '''
+    Stands in for the channel of a consumer replaying a capture file.
+    Acknowledgements and rejections have nowhere to go and are discarded.
+    '''
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+    def basic_reject(self, delivery_tag, requeue):
+        pass
+
+    def send_method(self, *args, **kwargs):
+        pass
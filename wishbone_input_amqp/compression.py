@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  compression.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class DecompressionError(Exception):
+    pass
+
+
+def inflate(wbits):
+
+    def decompress(body, max_size):
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            result = decompressor.decompress(body, max_size + 1)
+        except zlib.error as err:
+            raise DecompressionError("Invalid compressed data. %s" % (err))
+        if len(result) > max_size:
+            raise DecompressionError("Decompressed size exceeds %s bytes." % (max_size))
+        if not decompressor.eof:
+            raise DecompressionError("Truncated compressed data.")
+        return result
+
+    return decompress
+
+
+def decompressLZ4(body, max_size):
+
+    if lz4 is None:
+        raise DecompressionError("Decompressing lz4 requires the lz4 package.")
+    try:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        result = decompressor.decompress(body, max_length=max_size + 1)
+    except RuntimeError as err:
+        raise DecompressionError("Invalid compressed data. %s" % (err))
+    if len(result) > max_size:
+        raise DecompressionError("Decompressed size exceeds %s bytes." % (max_size))
+    if not decompressor.eof:
+        raise DecompressionError("Truncated compressed data.")
+    return result
+
+
+def decompressZstd(body, max_size):
+
+    if zstandard is None:
+        raise DecompressionError("Decompressing zstd requires the zstandard package.")
+    decompressor = zstandard.ZstdDecompressor()
+    try:
+        reader = decompressor.stream_reader(body, read_across_frames=True)
+        result = reader.read(max_size + 1)
+    except zstandard.ZstdError as err:
+        raise DecompressionError("Invalid compressed data. %s" % (err))
+    if len(result) > max_size:
+        raise DecompressionError("Decompressed size exceeds %s bytes." % (max_size))
+
+    # The stream reader silently stops at a truncated frame so check each
+    # frame is complete.  The output is known not to exceed max_size by now.
+    remaining = body
+    try:
+        while True:
+            frame = decompressor.decompressobj()
+            frame.decompress(remaining)
+            if not frame.eof:
+                raise DecompressionError("Truncated compressed data.")
+            remaining = frame.unused_data
+            if not remaining:
+                break
+    except zstandard.ZstdError as err:
+        raise DecompressionError("Invalid compressed data. %s" % (err))
+    return result
+
+
+CODECS = {
+    "deflate": inflate(zlib.MAX_WBITS),
+    "gzip": inflate(16 + zlib.MAX_WBITS),
+    "lz4": decompressLZ4,
+    "x-gzip": inflate(16 + zlib.MAX_WBITS),
+    "zlib": inflate(zlib.MAX_WBITS),
+    "zstd": decompressZstd
+}
+
+
+def decompress(codec, body, max_size):
+    '''
+    Decompresses ``body`` encoded with ``codec``.
+
+    Decompression stops as soon as the output exceeds ``max_size`` so a
+    small but highly compressed body cannot exhaust memory.
+
+    Args:
+        codec (str): One of the names in ``CODECS``.
+        body (bytes): The compressed data.
+        max_size (int): The max number of decompressed bytes.
+
+    Returns:
+        bytes: The decompressed data.
+
+    Raises:
+        DecompressionError: ``body`` is invalid, truncated or too large.
+    '''
+
+    return CODECS[codec](body, max_size)
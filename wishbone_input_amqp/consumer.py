@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  consumer.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from collections import deque
+
+
+class Binding(object):
+
+    '''
+    A queue to consume and the exchange and routing keys it is bound to.
+
+    Args:
+        routing_keys (list): The routing keys to bind the queue with.
+        **kwargs: The values of ``Binding.PARAMETERS``.
+    '''
+
+    PARAMETERS = [
+        "exchange",
+        "exchange_arguments",
+        "exchange_auto_delete",
+        "exchange_durable",
+        "exchange_passive",
+        "exchange_type",
+        "prefetch_count",
+        "queue",
+        "queue_arguments",
+        "queue_auto_delete",
+        "queue_declare",
+        "queue_durable",
+        "queue_exclusive"
+    ]
+
+    def __init__(self, routing_keys, **kwargs):
+
+        self.routing_keys = routing_keys
+        for name in self.PARAMETERS:
+            setattr(self, name, kwargs[name])
+
+
+class Link(object):
+
+    '''
+    A connection to the broker shared by one or more consumers.
+
+    Each link runs its own drain loop reading the frames of all the channels
+    opened on it.
+
+    Args:
+        index (int): The position of the link in the pool.
+
+    Attributes:
+        connection (amqp.connection.Connection): The broker connection.
+        connected (bool): True when the connection and its channels are set up.
+        consumers (list): The ``Consumer`` instances using this link.
+        actions (collections.deque): Functions to execute from within the
+            drain loop.
+    '''
+
+    def __init__(self, index):
+
+        self.index = index
+        self.actions = deque()
+        self.connection = None
+        self.connected = False
+        self.consumers = []
+
+
+class Consumer(object):
+
+    '''
+    A channel consuming a queue on a ``Link``.
+
+    Args:
+        index (int): The position of the consumer in the pool. Events refer
+                     to it so acknowledgements are routed to the channel
+                     owning the delivery tag.
+        link (Link): The link on which the channel is opened.
+        binding (Binding): The queue to consume.
+
+    Attributes:
+        batch (list): The decoded items collected for the next batch event.
+        batch_tags (list): The delivery tags of the messages in ``batch``.
+        channel (amqp.channel.Channel): The channel.
+        confirms (dict): The delivery tags of the retried messages by the
+            publish sequence number of their republished copy, awaiting a
+            publisher confirm.
+        dedup_keys (dict): The deduplication keys of the unsettled delivery
+            tags of ``channel``.
+        generation (int): The number of times ``channel`` was opened.
+        messages (dict): The unsettled messages of ``channel`` by delivery
+            tag, kept when cancelled messages are retried.
+        next_offset (int): The stream offset following the last message
+            delivered on ``channel`` or None when nothing was delivered yet.
+        offsets (dict): The stream offsets of the unsettled delivery tags of
+            ``channel``.
+        prefetch (int): The current prefetch count of the channel.
+        published (int): The number of messages published on ``channel``.
+        returned (set): The publish sequence numbers of the republished
+            copies returned as unroutable.
+        tag (str): The consumer tag.
+        tracker (wishbone_input_amqp.delivery.DeliveryTracker): Keeps track of
+            the delivery tags of ``channel``.
+    '''
+
+    def __init__(self, index, link, binding):
+
+        self.index = index
+        self.link = link
+        self.binding = binding
+        self.batch = []
+        self.batch_tags = []
+        self.channel = None
+        self.confirms = {}
+        self.dedup_keys = {}
+        self.messages = {}
+        self.next_offset = None
+        self.offsets = {}
+        self.generation = 0
+        self.prefetch = binding.prefetch_count
+        self.published = 0
+        self.returned = set()
+        self.tag = "wishbone-%s" % (index)
+        self.tracker = None
+        link.consumers.append(self)
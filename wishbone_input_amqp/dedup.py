@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dedup.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from collections import OrderedDict
+from time import time
+
+
+class DeduplicationCache(object):
+
+    '''
+    Remembers the keys of recently received messages.
+
+    The cache holds at most ``size`` keys and evicts the least recently
+    seen key first.  When ``ttl`` is set, keys are forgotten ``ttl`` seconds
+    after they were last seen.
+
+    Args:
+        size (int): The max number of keys to remember.
+        ttl (float): The number of seconds to remember a key.  0 remembers
+                     keys until evicted.
+    '''
+
+    def __init__(self, size=100000, ttl=0):
+
+        self.size = size
+        self.ttl = ttl
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        '''
+        Remembers ``key``.
+
+        Args:
+            key (str/bytes): The key.
+        '''
+
+        self.keys[key] = time()
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+
+    def discard(self, key):
+        '''
+        Forgets ``key``.
+
+        Args:
+            key (str/bytes): The key.
+        '''
+
+        self.keys.pop(key, None)
+
+    def seen(self, key):
+        '''
+        Returns True when ``key`` is remembered and refreshes it.
+
+        Args:
+            key (str/bytes): The key.
+
+        Returns:
+            bool: True when ``key`` has been seen before.
+        '''
+
+        if self.ttl > 0:
+            expired = time() - self.ttl
+            while self.keys:
+                oldest = next(iter(self.keys))
+                if self.keys[oldest] >= expired:
+                    break
+                del self.keys[oldest]
+
+        if key in self.keys:
+            self.add(key)
+            return True
+        else:
+            return False
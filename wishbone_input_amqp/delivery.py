@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  delivery.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from amqp import spec
+from array import array
+from time import time
+
+PENDING = 0
+ACK = 1
+NACK = 2
+SETTLED = 3
+REJECT = 4
+
+
+class DeliveryTracker(object):
+
+    '''
+    Keeps track of the delivery tags handed out on a single channel and
+    coalesces their acknowledgements into as few frames as possible.
+
+    The broker assigns delivery tags per channel as a sequence starting at 1
+    so the state, delivery time and size of each outstanding tag are stored
+    in arrays indexed relative to the lowest outstanding tag.
+
+    Acknowledged tags forming a contiguous range starting at the lowest
+    outstanding tag are settled with a single ``multiple`` frame.  Tags
+    settled out of order beyond a still pending tag are settled
+    individually.
+
+    A message can result in several events.  ``hold`` and ``release`` count
+    the events still referring to a tag so the message is only settled once
+    all of them are acknowledged or cancelled.
+
+    Delivery tags are only valid on the channel which delivered them.  A new
+    tracker, with a higher ``generation``, is created each time a channel is
+    reopened so tags of a previous channel can be recognized and dropped.
+
+    Args:
+        channel (amqp.channel.Channel): The channel owning the delivery tags.
+        generation (int): Identifies the channel among the channels
+                          previously opened by the same consumer.
+
+    Attributes:
+        acknowledged (int): The total number of acknowledged tags.
+        bytes (int): The number of body bytes of the pending tags.
+        generation (int): Identifies the channel.
+        pending (int): The number of delivered tags not settled yet.
+        settled (int): The number of settled tags awaiting a flush.
+    '''
+
+    def __init__(self, channel, generation=0):
+
+        self.channel = channel
+        self.generation = generation
+        self.base = 1
+        self.states = bytearray()
+        self.times = array('d')
+        self.sizes = array('Q')
+        self.references = {}
+        self.acknowledged = 0
+        self.bytes = 0
+        self.pending = 0
+        self.settled = 0
+
+    def ack(self, tag):
+        '''
+        Marks ``tag`` to be acknowledged on the next flush.
+
+        Args:
+            tag (int): The delivery tag.
+
+        Returns:
+            bool: False when ``tag`` is unknown or already settled.
+        '''
+
+        if self.__settle(tag, ACK):
+            self.acknowledged += 1
+            return True
+        else:
+            return False
+
+    def deliver(self, tag, size=0):
+        '''
+        Registers ``tag`` as delivered and pending acknowledgement.
+
+        Args:
+            tag (int): The delivery tag.
+            size (int): The number of body bytes of the message.
+        '''
+
+        gap = tag - self.base - len(self.states)
+        if gap < 0:
+            return
+        elif gap > 0:
+            self.states.extend(bytearray([SETTLED]) * gap)
+            self.times.extend(array('d', [0]) * gap)
+            self.sizes.extend(array('Q', [0]) * gap)
+        self.states.append(PENDING)
+        self.times.append(time())
+        self.sizes.append(size)
+        self.pending += 1
+        self.bytes += size
+
+    def deliveredAt(self, tag):
+        '''
+        Returns the time ``tag`` was delivered or None when unknown.
+
+        Args:
+            tag (int): The delivery tag.
+        '''
+
+        index = tag - self.base
+        if 0 <= index < len(self.times):
+            return self.times[index]
+
+    def expire(self, before):
+        '''
+        Marks the tags delivered before ``before`` and still pending to be
+        rejected and requeued on the next flush.
+
+        Args:
+            before (float): The delivery time before which tags expire.
+
+        Returns:
+            int: The number of expired tags.
+        '''
+
+        states = self.states
+        times = self.times
+        expired = 0
+        index = 0
+        while index < len(states) and times[index] < before:
+            if states[index] == PENDING:
+                states[index] = NACK
+                self.bytes -= self.sizes[index]
+                self.references.pop(self.base + index, None)
+                expired += 1
+            index += 1
+        self.pending -= expired
+        self.settled += expired
+        return expired
+
+    def flush(self):
+        '''
+        Sends the acknowledgements and rejections of all settled tags.
+        '''
+
+        states = self.states
+        frames = []
+        index = 0
+        while index < len(states) and states[index] != PENDING:
+            state = states[index]
+            if state != SETTLED:
+                if frames and frames[-1][0] == state:
+                    frames[-1][1] = self.base + index
+                else:
+                    frames.append([state, self.base + index])
+            index += 1
+
+        stragglers = []
+        for offset in range(index, len(states)):
+            if states[offset] not in (PENDING, SETTLED):
+                stragglers.append((states[offset], self.base + offset))
+                states[offset] = SETTLED
+
+        del states[:index]
+        del self.times[:index]
+        del self.sizes[:index]
+        self.base += index
+        self.settled = 0
+
+        for state, tag in frames:
+            self.__send(state, tag, True)
+        for state, tag in stragglers:
+            self.__send(state, tag, False)
+
+    def hold(self, tag, count=1):
+        '''
+        Registers ``count`` more events referring to ``tag``.
+
+        Args:
+            tag (int): The delivery tag.
+            count (int): The number of events.
+        '''
+
+        reference = self.references.get(tag)
+        if reference is None:
+            self.references[tag] = [count, False]
+        else:
+            reference[0] += count
+
+    def lowestPending(self):
+        '''
+        Returns the lowest delivery tag not settled yet or, when all tags are
+        settled, the next delivery tag.
+        '''
+
+        index = self.states.find(PENDING)
+        if index == -1:
+            index = len(self.states)
+        return self.base + index
+
+    def nack(self, tag):
+        '''
+        Marks ``tag`` to be rejected and requeued on the next flush.
+
+        Args:
+            tag (int): The delivery tag.
+
+        Returns:
+            bool: False when ``tag`` is unknown or already settled.
+        '''
+
+        return self.__settle(tag, NACK)
+
+    def reject(self, tag):
+        '''
+        Marks ``tag`` to be rejected without requeueing on the next flush.
+
+        Args:
+            tag (int): The delivery tag.
+
+        Returns:
+            bool: False when ``tag`` is unknown or already settled.
+        '''
+
+        return self.__settle(tag, REJECT)
+
+    def release(self, tag, cancelled=False):
+        '''
+        Releases one of the events referring to ``tag`` and returns how the
+        message should be settled.
+
+        Args:
+            tag (int): The delivery tag.
+            cancelled (bool): Whether the event was cancelled.
+
+        Returns:
+            int: PENDING while other events still refer to ``tag``.
+                 Otherwise NACK when any of them was cancelled or ACK.
+        '''
+
+        reference = self.references.get(tag)
+        if reference is None:
+            return NACK if cancelled else ACK
+        reference[0] -= 1
+        reference[1] = reference[1] or cancelled
+        if reference[0] > 0:
+            return PENDING
+        del self.references[tag]
+        return NACK if reference[1] else ACK
+
+    def __send(self, state, tag, multiple):
+
+        if state == ACK:
+            self.channel.basic_ack(tag, multiple=multiple)
+        elif multiple:
+            self.channel.send_method(spec.Basic.Nack, 'Lbb', (tag, True, state == NACK))
+        else:
+            self.channel.basic_reject(tag, state == NACK)
+
+    def __settle(self, tag, state):
+
+        index = tag - self.base
+        if 0 <= index < len(self.states) and self.states[index] == PENDING:
+            self.states[index] = state
+            self.bytes -= self.sizes[index]
+            self.references.pop(tag, None)
+            self.pending -= 1
+            self.settled += 1
+            return True
+        else:
+            return False
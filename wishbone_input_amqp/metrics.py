@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from time import time
+import random
+
+
+class Histogram(object):
+
+    '''
+    Collects samples and summarizes their distribution.
+
+    At most ``size`` samples are kept per interval.  Once full, samples
+    replace a random earlier one (reservoir sampling) so the summary stays
+    representative while the cost per sample remains constant.
+
+    Args:
+        size (int): The max number of samples to keep.
+    '''
+
+    def __init__(self, size=1024):
+
+        self.size = size
+        self.reset()
+
+    def add(self, value):
+        '''
+        Adds a sample.
+
+        Args:
+            value (float): The sample.
+        '''
+
+        self.count += 1
+        self.total += value
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            index = random.randint(0, self.count - 1)
+            if index < self.size:
+                self.samples[index] = value
+
+    def reset(self):
+        '''
+        Discards all samples.
+        '''
+
+        self.count = 0
+        self.total = 0.0
+        self.samples = []
+
+    def summary(self):
+        '''
+        Returns the count, min, max, mean and percentiles of the samples
+        and resets the histogram.
+
+        Returns:
+            dict: The summary of the samples.
+        '''
+
+        samples = sorted(self.samples)
+        if samples:
+            result = {
+                "count": self.count,
+                "min": samples[0],
+                "max": samples[-1],
+                "mean": self.total / self.count,
+                "p50": samples[int(len(samples) * 0.50)],
+                "p90": samples[int(len(samples) * 0.90)],
+                "p99": samples[int(len(samples) * 0.99)]
+            }
+        else:
+            result = {"count": 0}
+        self.reset()
+        return result
+
+
+class Metrics(object):
+
+    '''
+    The counters and histograms describing the hot path of ``AMQPIn``.
+
+    Counters are plain attributes so updating them costs a single
+    attribute increment.
+
+    Attributes:
+        ack_latency (Histogram): Seconds between delivery and acknowledgement.
+        acknowledged (int): The number of acknowledged messages.
+        bytes (int): The number of received body bytes.
+        cancelled (int): The number of cancelled messages.
+        decode_time (Histogram): Seconds spent decoding a message body.
+        dead_lettered (int): The number of messages rejected after running
+                             out of retry attempts.
+        dedup_hits (int): The number of dropped duplicate redeliveries.
+        dedup_misses (int): The number of redeliveries not seen before.
+        detection_time (Histogram): Seconds between the last data received
+                                    on a connection and detecting it failed.
+        deliveries (int): The number of received messages.
+        expired (int): The number of messages requeued because they were not
+                       acknowledged in time.
+        reconnects (int): The number of times a connection was lost.
+        redeliveries (int): The number of received messages flagged redelivered.
+        rejected (int): The number of messages rejected without requeueing
+                        because they could not be processed.
+        retried (int): The number of cancelled messages republished to a
+                       delay queue.
+        stale (int): The number of acknowledgements and cancellations dropped
+                     because the channel delivering the message was closed.
+        submit_blocked (float): Seconds spent waiting for room in a full queue.
+    '''
+
+    COUNTERS = ["acknowledged", "bytes", "cancelled", "dead_lettered", "dedup_hits", "dedup_misses", "deliveries", "expired", "reconnects", "redeliveries", "rejected", "retried", "stale", "submit_blocked"]
+    HISTOGRAMS = ["ack_latency", "decode_time", "detection_time"]
+
+    def __init__(self):
+
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+        self.previous = {}
+        self.previous_time = time()
+
+    def collect(self):
+        '''
+        Returns the current values of all counters and histograms.
+
+        Each counter results into a ``<name>_total`` and a ``<name>_rate``
+        value, the rate being the average per second since the previous
+        call.  Each histogram results into a ``<name>.<statistic>`` value.
+
+        Returns:
+            dict: Metric names and their values.
+        '''
+
+        now = time()
+        elapsed = max(now - self.previous_time, 0.000001)
+        result = {}
+        for name in self.COUNTERS:
+            value = getattr(self, name)
+            result["%s_total" % (name)] = value
+            result["%s_rate" % (name)] = (value - self.previous.get(name, 0)) / elapsed
+            self.previous[name] = value
+        for name in self.HISTOGRAMS:
+            for statistic, value in getattr(self, name).summary().items():
+                result["%s.%s" % (name, statistic)] = value
+        self.previous_time = now
+        return result
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  native.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from scalpl import Cut
+from time import time
+from wishbone.event import Event as Wishbone_Event
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+NATIVE_FIELDS = frozenset([
+    "bulk",
+    "cloned",
+    "data",
+    "errors",
+    "tags",
+    "timestamp",
+    "tmp",
+    "ttl",
+    "uuid",
+    "uuid_previous"
+])
+
+
+class MsgpackDecoder(object):
+
+    '''
+    Decodes msgpack encoded native Wishbone events.
+
+    Follows the interface of the Wishbone decoders: ``handler`` yields the
+    decoded objects of the data it receives and None ends the stream.
+    '''
+
+    def handler(self, data):
+
+        if data is not None:
+            yield msgpack.unpackb(data, raw=False)
+
+
+def buildEvent(data, destination=None):
+    '''
+    Returns the ``wishbone.event.Event`` of the native event ``data`` as
+    exported by ``Event.dump()``.
+
+    Events having exactly the fields and field types ``Event.dump()``
+    produces are wrapped as is.  Other events are validated by
+    ``Event.slurp()``.
+
+    Args:
+        data (dict): The native event.
+        destination (str): Unused.  Native events define their own data.
+
+    Returns:
+        wishbone.event.Event: The event.
+
+    Raises:
+        wishbone.error.InvalidData: ``data`` is not a valid native event.
+    '''
+
+    if type(data) is dict and data.keys() == NATIVE_FIELDS and \
+            type(data["tmp"]) is dict and \
+            type(data["errors"]) is dict and \
+            type(data["tags"]) is list and \
+            type(data["uuid_previous"]) is list and \
+            type(data["uuid"]) is str and \
+            type(data["bulk"]) is bool and \
+            type(data["cloned"]) is bool and \
+            type(data["ttl"]) is int and \
+            type(data["timestamp"]) is float:
+        data["timestamp"] = time()
+        event = Wishbone_Event.__new__(Wishbone_Event)
+        event.data = Cut(data)
+        event.bulk_size = 100
+        return event
+    else:
+        return Wishbone_Event().slurp(data)
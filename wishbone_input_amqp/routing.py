@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  routing.py
+#
+#  Copyright 2016 Jelle Smet <development@smetj.net>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+
+class Node(object):
+
+    __slots__ = ("children", "targets")
+
+    def __init__(self):
+
+        self.children = {}
+        self.targets = []
+
+
+class TopicMatcher(object):
+
+    '''
+    Maps routing keys to targets using AMQP topic patterns.
+
+    Patterns are words separated by dots in which "*" matches exactly one
+    word and "#" matches zero or more words.  They are compiled into a trie
+    of words once.  The result of each routing key is cached so matching a
+    known routing key costs a single dict lookup.
+
+    Args:
+        patterns (dict): Patterns and the target or list of targets they
+                         map to.
+        default (tuple): The targets of routing keys matching no pattern.
+        cache_size (int): The max number of routing keys to cache.
+    '''
+
+    def __init__(self, patterns, default=(), cache_size=10000):
+
+        self.root = Node()
+        self.default = tuple(default)
+        self.cache_size = cache_size
+        self.cache = {}
+        for pattern, targets in patterns.items():
+            if isinstance(targets, str):
+                targets = [targets]
+            node = self.root
+            for word in pattern.split("."):
+                node = node.children.setdefault(word, Node())
+            for target in targets:
+                if target not in node.targets:
+                    node.targets.append(target)
+
+    def match(self, routing_key):
+        '''
+        Returns the targets of ``routing_key``.
+
+        Args:
+            routing_key (str): The routing key.
+
+        Returns:
+            tuple: The targets, each listed once.
+        '''
+
+        try:
+            return self.cache[routing_key]
+        except KeyError:
+            pass
+
+        targets = {}
+        self.__match(self.root, routing_key.split("."), 0, targets)
+        result = tuple(targets) or self.default
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[routing_key] = result
+        return result
+
+    def __match(self, node, words, index, targets):
+
+        if index == len(words):
+            for target in node.targets:
+                targets[target] = None
+        else:
+            child = node.children.get(words[index])
+            if child is not None:
+                self.__match(child, words, index + 1, targets)
+            child = node.children.get("*")
+            if child is not None:
+                self.__match(child, words, index + 1, targets)
+
+        child = node.children.get("#")
+        if child is not None:
+            for position in range(index, len(words) + 1):
+                self.__match(child, words, position, targets)